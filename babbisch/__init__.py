@@ -1,15 +1,39 @@
 from __future__ import with_statement
 
+import hashlib
+import itertools
 import os.path
+import sys
 from optparse import OptionParser
 
-from babbisch.utils import ASTCache
+from babbisch.utils import ASTCache, PREPROCESSORS, write_depfile, write_file
 from babbisch.analyze import AnalyzingVisitor
 from babbisch.filter import include_exclude
+from babbisch.database import write_database
+from babbisch.corpus import analyze_corpus
 
-USAGE = 'usage: %prog [options] headerfile...'
+USAGE = 'usage: %prog [options] headerfile...\n       %prog [options] --corpus DIR -o OUTDIR'
+
+def write_json(visitor, filename):
+    chunks = visitor.iter_json(indent=2, sort_keys=True)
+    if filename is None:
+        # just print it
+        digest = hashlib.sha1()
+        for chunk in itertools.chain(chunks, ['\n']):
+            digest.update(chunk)
+            sys.stdout.write(chunk)
+        hexdigest = digest.hexdigest()
+    else:
+        # don't touch the file if nothing changed, so build tools
+        # don't rebuild everything depending on it.
+        written, hexdigest = write_file(filename, chunks, only_if_changed=True)
+    # report the content hash like sha1sum does
+    print >>sys.stderr, '%s  %s' % (hexdigest, filename or '-')
+
+# format: (output function, needs an output filename)
 FORMATS = {
-        'json': lambda visitor: visitor.to_json(indent=2)
+        'json': (write_json, False),
+        'sqlite': (write_database, True),
         }
 
 def main():
@@ -25,7 +49,14 @@ def main():
             choices=FORMATS.keys(),
             dest='format',
             default='json',
-            help="defines the output format to use [supported: json]",
+            help="defines the output format to use [supported: %s]" % ', '.join(sorted(FORMATS)),
+            )
+    parser.add_option('--preprocessor',
+            action='store',
+            choices=PREPROCESSORS,
+            dest='preprocessor',
+            default='cpp',
+            help="preprocessor to use: the external cpp or the built-in python one [default: cpp]",
             )
     parser.add_option('-i', '--include-header',
             action='append',
@@ -45,11 +76,39 @@ def main():
             action='store',
             dest='output',
             default=None,
-            help="defines the output filename [default: stdout]",
+            help="defines the output filename [default: stdout]. The sqlite format appends to an existing database.",
+            )
+    parser.add_option('--depfile',
+            action='store',
+            dest='depfile',
+            default=None,
+            help="write a make-compatible dependency file listing all headers read to FILE (needs -o)",
+            metavar='FILE'
+            )
+    parser.add_option('--corpus',
+            action='store',
+            dest='corpus',
+            default=None,
+            help="analyze all headers below DIR, writing one json file per header and a merged sqlite database to the directory given by -o",
+            metavar='DIR'
+            )
+    parser.add_option('-j', '--jobs',
+            action='store',
+            type='int',
+            dest='jobs',
+            default=None,
+            help="number of worker processes in corpus mode [default: number of CPUs]",
             )
     options, args = parser.parse_args()
+    if options.corpus is not None:
+        return main_corpus(parser, options, args)
     if not args:
         parser.error("You have to specify at least one input file")
+    write, needs_filename = FORMATS[options.format]
+    if needs_filename and options.output is None:
+        parser.error("The %s format needs an output filename (-o)" % options.format)
+    if options.depfile is not None and options.output is None:
+        parser.error("--depfile needs an output filename (-o)")
 
     options.include_headers.extend(args)
     # read and analyze all source files
@@ -58,25 +117,50 @@ def main():
             )
     cache = ASTCache(
             load=options.cache,
+            preprocessor=options.preprocessor,
             )
+    dependencies = []
     try:
         for filename in args:
             if not os.path.isfile(filename):
                 parser.error("'%s' is not a valid filename" % filename)
             else:
                 path = os.path.abspath(filename)
-                ast = cache.get_header(path)
-                visitor.visit(ast)
+                visitor.visit_decls(cache.iter_header(path, visitor.include))
+                dependencies.extend(cache.get_dependencies(path, visitor.include))
     finally:
         if options.cache:
             cache.save()
 
+    visitor.resolve_types()
     # output
-    stuff = FORMATS[options.format](visitor)
+    write(visitor, options.output)
+    if options.depfile is not None:
+        write_depfile(options.depfile, options.output, dependencies)
+
+def main_corpus(parser, options, args):
+    if args:
+        parser.error("--corpus doesn't take input files")
     if options.output is None:
-        # just print it
-        print stuff
-    else:
-        with open(options.output, 'w') as f:
-            f.write(stuff)
+        parser.error("--corpus needs an output directory (-o)")
+    if not os.path.isdir(options.corpus):
+        parser.error("'%s' is not a directory" % options.corpus)
+    cache = None
+    if options.cache:
+        cache = ASTCache(preprocessor=options.preprocessor)
+    try:
+        analyzed, skipped, failures = analyze_corpus(options.corpus,
+                options.output,
+                cache,
+                options.include_headers,
+                options.exclude_headers,
+                options.jobs,
+                options.preprocessor)
+    finally:
+        if options.cache:
+            cache.save()
+    print >>sys.stderr, '%d headers analyzed, %d up to date, %d failed' % (
+            analyzed, skipped, len(failures))
+    if failures:
+        sys.exit(1)
 
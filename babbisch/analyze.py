@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import itertools
 import operator
+import sys
 
 from pycparser import c_parser, c_ast, parse_file
 
+from .model import CANONICAL_TYPES_KEY
 from .odict import odict
 
 def format_tag(something):
@@ -27,11 +30,54 @@ def format_type(type, objects):
         type = type.tag
     return type
 
+class LookupRecorder(object):
+    """
+        wraps the *objects* dict passed to `Object.get_state` and
+        records which tags were looked up and whether they were known.
+    """
+    def __init__(self, objects):
+        self.objects = objects
+        self.lookups = []
+
+    def __contains__(self, tag):
+        known = tag in self.objects
+        self.lookups.append((tag, known))
+        return known
+
+    def __getitem__(self, tag):
+        self.lookups.append((tag, True))
+        return self.objects[tag]
+
+def lookups_valid(lookups, objects):
+    """
+        return True if all tags recorded by a `LookupRecorder` are
+        still (un)known in *objects*.
+    """
+    for tag, known in lookups:
+        if (tag in objects) != known:
+            return False
+    return True
+
 class Object(object):
+    # (lookups, state) and (options, lookups, nested objects and their
+    # versions, fragment), see `get_cached_state` and `encode_objects`.
+    _state_cache = None
+    _fragment_cache = None
+    _version = 0
+
     def __init__(self, coord, tag):
         self.coord = coord
         self.tag = tag
 
+    def invalidate(self):
+        """
+            drop the cached state and JSON fragment. Call this
+            whenever the object is modified.
+        """
+        self._version += 1
+        self._state_cache = None
+        self._fragment_cache = None
+
     def __repr__(self):
         return '<%s at 0x%x "%s">' % (
                 self.__class__.__name__,
@@ -44,6 +90,20 @@ class Object(object):
                 'class': self.__class__.__name__
                 }
 
+    def get_cached_state(self, objects):
+        """
+            like `get_state`, but the state is only rebuilt if the
+            object was invalidated or one of the tags it refers to
+            was added to or removed from *objects*.
+        """
+        cache = self._state_cache
+        if cache is not None and lookups_valid(cache[0], objects):
+            return cache[1]
+        recorder = LookupRecorder(objects)
+        state = self.get_state(recorder)
+        self._state_cache = (recorder.lookups, state)
+        return state
+
 class Type(Object):
     pass
 
@@ -92,9 +152,11 @@ class Compound(Type):
         if not isinstance(members, odict):
             members = odict(members)
         self.members.update(members)
+        self.invalidate()
 
     def add_member(self, name, type):
         self.members[name] = type
+        self.invalidate()
 
     def get_state(self, objects):
         state = Type.get_state(self, objects)
@@ -111,6 +173,7 @@ class Struct(Compound):
 
     def add_member(self, name, type, bitsize):
         self.members[name] = (type, bitsize)
+        self.invalidate()
 
     def get_state(self, objects):
         state = Type.get_state(self, objects)
@@ -127,6 +190,7 @@ class Enum(Compound):
 
     def add_member(self, name, type):
         self.members[name] = type
+        self.invalidate()
 
     def get_state(self, objects):
         state = Type.get_state(self, objects)
@@ -247,6 +311,10 @@ SYNONYMS = {
 def _get_builtins():
     d = dict((name, PrimitiveType(None, name)) for name in TYPES)
     for synonym, of in SYNONYMS.iteritems():
+        # synonyms may refer to other synonyms, so don't depend
+        # on the dict order here.
+        while of in SYNONYMS:
+            of = SYNONYMS[of]
         d[synonym] = d[of]
     return d
 
@@ -309,11 +377,79 @@ def resolve_constant(node, resolver=None):
         node.show()
         assert 0, "Don't know %s" % node
 
+def encode_object(obj, objects, json, indent=None, sort_keys=False):
+    """
+        return the JSON encoding of *obj*'s state. The encoding is
+        cached and reused as long as neither *obj* nor any of the
+        inline objects it contains were invalidated and all tags
+        they refer to are still (un)known in *objects*.
+    """
+    options = (indent, sort_keys)
+    cache = obj._fragment_cache
+    if (cache is not None
+            and cache[0] == options
+            and lookups_valid(cache[1], objects)
+            and all(o._version == version for o, version in cache[2])):
+        return cache[3]
+    lookups = []
+    nested = []
+    def _default(o):
+        state = o.get_cached_state(objects)
+        lookups.extend(o._state_cache[0])
+        nested.append((o, o._version))
+        return state
+    state = obj.get_cached_state(objects)
+    lookups.extend(obj._state_cache[0])
+    fragment = json.dumps(state,
+            default=_default,
+            indent=indent,
+            sort_keys=sort_keys,
+            separators=(', ', ': '))
+    obj._fragment_cache = (options, lookups, nested, fragment)
+    return fragment
+
+def iter_fragments(pairs, indent=None):
+    """
+        yield the chunks of a JSON list of the encoded (key, state)
+        pairs from the iterable *pairs*, formatted like ``json.dumps``
+        would do it.
+    """
+    if indent is None:
+        separator = ', '
+        start, end = '[', ']'
+        pair_format = '[%s, %s]'
+    else:
+        outer = '\n' + ' ' * indent
+        inner = '\n' + ' ' * (2 * indent)
+        separator = ', ' + outer
+        start, end = '[' + outer, '\n]'
+        pair_format = '[' + inner + '%s, ' + inner + '%s' + outer + ']'
+    first = True
+    for key, fragment in pairs:
+        if first:
+            yield start
+            first = False
+        else:
+            yield separator
+        if indent is not None:
+            fragment = fragment.replace('\n', inner)
+        yield pair_format % (key, fragment)
+    if first:
+        yield '[]'
+    else:
+        yield end
+
 class AnalyzingVisitor(c_ast.NodeVisitor):
     def __init__(self, builtins=BUILTINS, include=None):
         self.objects = odict() # typedefs, structs, unions, enums, stuff, functions go here
-        self.objects.update(builtins)
+        # sorted, so the output doesn't depend on dict ordering
+        for name in sorted(builtins):
+            self.objects[name] = builtins[name]
         self.include = include
+        self.canonical_types = None # see `resolve_types`
+        # tag: the struct or union with a body. `objects` may hold an
+        # empty one, if the definition was followed by a reference.
+        self.definitions = {}
 
     def _include_object(self, obj):
         if (obj.coord is not None and self.include is not None):
@@ -321,15 +457,206 @@ class AnalyzingVisitor(c_ast.NodeVisitor):
                 return False
         return True
 
-    def to_json(self, **kwargs):
+    def iter_json(self, **kwargs):
+        """
+            yield the JSON output in chunks, so it can be written
+            without building the whole string in memory.
+        """
         try:
             import simplejson as json
         except ImportError:
             import json
-        return json.dumps(
-                [(k, v) for k, v in self.objects.iteritems() if self._include_object(v)],
-                default=lambda obj: obj.get_state(self.objects),
-                **kwargs)
+        objects = [(k, v) for k, v in self.objects.iteritems() if self._include_object(v)]
+        extra = []
+        if self.canonical_types is not None:
+            extra.append((CANONICAL_TYPES_KEY, {
+                'class': 'CanonicalTypes',
+                'coord': None,
+                'tag': CANONICAL_TYPES_KEY,
+                'types': self.canonical_types,
+                }))
+        if not set(kwargs) <= set(('indent', 'sort_keys')):
+            encoder = json.JSONEncoder(
+                    default=lambda obj: obj.get_cached_state(self.objects),
+                    **kwargs)
+            return encoder.iterencode(objects + extra)
+        # encode each object on its own, so the fragments can be cached
+        return iter_fragments(
+                itertools.chain(
+                    ((json.dumps(k), encode_object(v, self.objects, json, **kwargs))
+                        for k, v in objects),
+                    ((json.dumps(k), json.dumps(v, separators=(', ', ': '), **kwargs))
+                        for k, v in extra)),
+                kwargs.get('indent'))
+
+    def to_json(self, **kwargs):
+        return ''.join(self.iter_json(**kwargs))
+
+    def resolve_types(self):
+        """
+            compute the canonical type index for all included objects
+            and store it in `canonical_types`, so it is part of the
+            JSON output. It maps object keys to dicts:
+
+            ``canonical``
+                the tag with all typedefs replaced by their targets,
+                e.g. ``POINTER(STRUCT(_cairo))`` for ``POINTER(cairo_t)``.
+                Typedefs of anonymous structs, unions and enums are
+                kept. For functions, this is the typedef-free function
+                type.
+            ``kind``
+                the class of the object at the end of the typedef chain
+            ``typedefs``
+                the typedefs followed to get there
+            ``opaque``
+                True if that object is a struct or union without a
+                known definition
+            ``cyclic``
+                True if the object is on a cycle of references through
+                typedefs, pointers, arrays, struct or union members or
+                function types, like the nodes of a linked list.
+            ``reaches_cycle``
+                True if the object is cyclic or refers to a cyclic
+                object, like a function taking a list node.
+        """
+        tags = {} # id(obj): typedef-free tag
+        cycles = {} # id(type node): (cyclic, reaches_cycle)
+        types = {}
+        for key, obj in self.objects.iteritems():
+            if not self._include_object(obj):
+                continue
+            typedefs = []
+            target = obj
+            while isinstance(target, Typedef) and target.target is not None:
+                typedefs.append(target.tag)
+                target = target.target
+            canonical = self._typedef_free_tag(obj, tags)
+            # anonymous structs and unions always have a body
+            opaque = (isinstance(target, (Struct, Union))
+                    and target.name is not None
+                    and target.tag not in self.definitions)
+            cyclic, reaches_cycle = self._find_cycles(obj, cycles)
+            types[key] = {
+                    'canonical': canonical,
+                    'kind': type(target).__name__,
+                    'typedefs': typedefs,
+                    'opaque': opaque,
+                    'cyclic': cyclic,
+                    'reaches_cycle': reaches_cycle,
+                    }
+        self.canonical_types = types
+        return types
+
+    def _typedef_free_tag(self, obj, tags):
+        if obj is None:
+            return format_tag(None)
+        try:
+            return tags[id(obj)]
+        except KeyError:
+            pass
+        def _resolve(o):
+            return self._typedef_free_tag(o, tags)
+        if isinstance(obj, Typedef):
+            if (isinstance(obj.target, Compound)
+                    and obj.target.name is None):
+                # the typedef is the only name of anonymous
+                # structs, unions and enums, so keep it.
+                tag = obj.tag
+            else:
+                tag = _resolve(obj.target)
+        elif isinstance(obj, Pointer):
+            tag = 'POINTER(%s)' % _resolve(obj.type)
+        elif isinstance(obj, Array):
+            tag = 'ARRAY(%s, %s)' % (_resolve(obj.type), format_tag(obj.size))
+        elif isinstance(obj, Function):
+            tag = 'FUNCTIONTYPE(%s)' % ', '.join(_resolve(a)
+                    for a in [obj.rettype] + obj.arguments.values())
+        elif isinstance(obj, FunctionType):
+            tag = 'FUNCTIONTYPE(%s)' % ', '.join(_resolve(a)
+                    for a in [obj.rettype] + obj.argtypes)
+        else:
+            tag = obj.tag
+        tags[id(obj)] = tag
+        return tag
+
+    def _referenced_types(self, obj):
+        if isinstance(obj, Typedef):
+            return [obj.target]
+        elif isinstance(obj, (Pointer, Array)):
+            return [obj.type]
+        elif isinstance(obj, Function):
+            return [obj.rettype] + obj.arguments.values()
+        elif isinstance(obj, FunctionType):
+            return [obj.rettype] + obj.argtypes
+        elif isinstance(obj, Struct):
+            definition = self.definitions.get(obj.tag, obj)
+            return [typ for typ, bitsize in definition.members.values()]
+        elif isinstance(obj, Union):
+            return self.definitions.get(obj.tag, obj).members.values()
+        return []
+
+    def _type_node(self, obj):
+        """
+            return the node of *obj* in the type graph. Every reference
+            to a struct or union is a new object, so they are replaced
+            by their definitions.
+        """
+        if isinstance(obj, (Struct, Union)):
+            return self.definitions.get(obj.tag, obj)
+        return obj
+
+    def _find_cycles(self, obj, cycles):
+        """
+            return ``(cyclic, reaches_cycle)`` for *obj*, see
+            `resolve_types`. The strongly connected components of
+            the type graph are found with Tarjan's algorithm, and
+            the results are stored in *cycles* for all type nodes
+            reachable from *obj*.
+        """
+        index = {} # id(node): visiting order
+        lowlink = {} # id(node): lowest order reachable
+        successors = {} # id(node): [referenced type nodes]
+        stack = []
+        def _connect(node):
+            index[id(node)] = lowlink[id(node)] = len(index)
+            stack.append(node)
+            successors[id(node)] = [self._type_node(typ)
+                    for typ in self._referenced_types(node)
+                    if typ is not None]
+            for succ in successors[id(node)]:
+                if id(succ) in cycles:
+                    # in a component that is already done
+                    continue
+                if id(succ) not in index:
+                    _connect(succ)
+                    lowlink[id(node)] = min(lowlink[id(node)],
+                            lowlink[id(succ)])
+                else:
+                    # still on the stack
+                    lowlink[id(node)] = min(lowlink[id(node)],
+                            index[id(succ)])
+            if lowlink[id(node)] != index[id(node)]:
+                return
+            component = []
+            while not component or component[-1] is not node:
+                component.append(stack.pop())
+            members = set(id(member) for member in component)
+            cyclic = (len(component) > 1
+                    or any(succ is node for succ in successors[id(node)]))
+            # components are done in reverse topological order, so
+            # all other components referenced here are known already
+            reaches_cycle = cyclic or any(cycles[id(succ)][1]
+                    for member in component
+                    for succ in successors[id(member)]
+                    if id(succ) not in members)
+            for member in component:
+                cycles[id(member)] = (cyclic, reaches_cycle)
+        node = self._type_node(obj)
+        if node is None:
+            return False, False
+        if id(node) not in cycles:
+            _connect(node)
+        return cycles[id(node)]
 
     def generic_visit(self, node):
         # new generic visit method: just do nothing for unknown nodes.
@@ -343,6 +670,7 @@ class AnalyzingVisitor(c_ast.NodeVisitor):
         if isinstance(node.type, c_ast.FuncDecl):
             obj = self.visit(node.type)
             obj.storage.extend(node.storage)
+            obj.invalidate()
         else:
             # I think we'll just visit the type node. TODO: Really do that?
             self.visit(node.type)
@@ -354,8 +682,16 @@ class AnalyzingVisitor(c_ast.NodeVisitor):
             self.visit(node.decl.type)
 
     def visit_FileAST(self, node):
-        for child in node.children():
-            self.visit(child)
+        self.visit_decls(node.ext or ())
+
+    def visit_decls(self, decls):
+        """
+            visit the top-level declarations from the iterable *decls*
+            one at a time. Pass a generator (e.g. `ASTCache.iter_header`)
+            to release each declaration once it has been analyzed.
+        """
+        for decl in decls:
+            self.visit(decl)
 
     def resolve_type(self, node):
         if isinstance(node, c_ast.IdentifierType):
@@ -384,8 +720,9 @@ class AnalyzingVisitor(c_ast.NodeVisitor):
                     dim
                     )
         else:
-            print 'Unknown type: ',
-            node.show()
+            # not to stdout, that's where the JSON output goes
+            print >>sys.stderr, 'Unknown type: ',
+            node.show(buf=sys.stderr)
 
     def add_type(self, type):
         self.objects[type.tag] = type
@@ -439,6 +776,8 @@ class AnalyzingVisitor(c_ast.NodeVisitor):
         # the list of known objects
         if node.name is not None:
             self.add_type(type)
+            if node.decls is not None:
+                self.definitions[type.tag] = type
         # return it, so visit_Typedef can handle anonymous structs
         return type
 
@@ -450,6 +789,8 @@ class AnalyzingVisitor(c_ast.NodeVisitor):
         # the list of known objects
         if node.name is not None:
             self.add_type(type)
+            if node.decls is not None:
+                self.definitions[type.tag] = type
         # return it, so visit_Typedef can handle anonymous structs
         return type
 
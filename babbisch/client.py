@@ -1,11 +1,46 @@
+from .model import ObjectModel, load, loads
+
 class ObjectVisitor(object):
+    """
+        calls ``visit_<class>(obj)`` for every object, or
+        `generic_visit` if there is no such method. The methods are
+        looked up (with ``getattr``, so handlers set on the instance
+        work too) once, on the first call of `visit`; handlers added
+        later are only used after calling `reset_dispatch_table`.
+    """
+    # {object class name: bound visit method}, built by `visit`
+    _dispatch_table = None
+    # visit_* methods that don't handle an object class
+    _not_handlers = frozenset(['visit_objects', 'visit_model'])
+
     def visit_objects(self, objects):
         for tag, obj in objects.iteritems():
             self.visit(obj)
 
+    def visit_model(self, model):
+        """
+            visit all objects of the `ObjectModel` *model*,
+            synonyms only once.
+        """
+        for obj in model.unique_objects():
+            self.visit(obj)
+
     def generic_visit(self, obj):
         pass
 
+    def get_dispatch_table(self):
+        if self._dispatch_table is None:
+            self._dispatch_table = dict(
+                    (name[len('visit_'):], getattr(self, name))
+                    for name in dir(self) if name.startswith('visit_')
+                    and name not in self._not_handlers)
+        return self._dispatch_table
+
+    def reset_dispatch_table(self):
+        self._dispatch_table = None
+
     def visit(self, obj):
-        visitor_name = 'visit_%s' % obj['class']
-        return getattr(self, visitor_name, self.generic_visit)(obj)
+        method = self.get_dispatch_table().get(obj['class'])
+        if method is None:
+            return self.generic_visit(obj)
+        return method(obj)
@@ -0,0 +1,169 @@
+"""
+    analyze all headers below a directory using worker processes.
+
+    Every header gets its own JSON output in the output directory, and
+    all objects are merged into one deduplicated SQLite database (see
+    `babbisch.database`). The files read for each header are listed in a
+    make-style dependency file next to its output; headers whose output
+    is newer than all of them are skipped, so an interrupted run can
+    just be restarted.
+"""
+from __future__ import with_statement
+
+import os
+import re
+import sys
+import traceback
+from multiprocessing import Pool
+
+from .analyze import AnalyzingVisitor
+from .database import create_schema, write_database
+from .filter import include_exclude
+from .utils import (ASTCache, newest_mtime, read_depfile, write_depfile,
+        write_file)
+
+DATABASE_FILENAME = 'types.db'
+FAILURES_FILENAME = 'failures.txt'
+HEADER_EXTENSIONS = ('.h',)
+DEPFILE_EXTENSION = '.d'
+
+def find_headers(directory):
+    """
+        return a sorted list of the absolute paths of all headers
+        below *directory*.
+    """
+    headers = []
+    for dirpath, dirnames, filenames in os.walk(os.path.abspath(directory)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(HEADER_EXTENSIONS):
+                headers.append(os.path.join(dirpath, filename))
+    return headers
+
+def is_done(header, output):
+    dependencies = read_depfile(output + DEPFILE_EXTENSION)
+    if dependencies is None:
+        return False
+    newest = newest_mtime([header] + dependencies)
+    try:
+        return newest is not None and os.stat(output).st_mtime >= newest
+    except OSError:
+        return False
+
+def write_output(filename, chunks):
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another worker may have created it in the meantime
+            if not os.path.isdir(dirname):
+                raise
+    # always write, `is_done` relies on the mtime
+    write_file(filename, chunks)
+
+# the `ASTCache` of a worker process, inherited from the parent process,
+# and whether new cache entries are sent back to it.
+_cache = None
+_collect = False
+
+def _init_worker(cache, preprocessor):
+    global _cache, _collect
+    _collect = cache is not None
+    if cache is None:
+        cache = ASTCache(load=False, preprocessor=preprocessor)
+    # the traceback is enough, don't print whole preprocessed headers
+    cache.verbose = False
+    _cache = cache
+
+def analyze_header(task):
+    """
+        analyze a single header in a worker process. Returns a tuple
+        ``(header, cache entries, error)``: the cache entries are a dict
+        of the entries added while parsing the header, *error* is a
+        formatted traceback if the analysis failed.
+    """
+    header, output, database, include_headers, exclude_headers = task
+    _cache.updated.clear()
+    try:
+        visitor = AnalyzingVisitor(
+                include=include_exclude(
+                    include_headers + [re.escape(header) + '$'],
+                    exclude_headers)
+                )
+        visitor.visit_decls(_cache.iter_header(header, visitor.include))
+        visitor.resolve_types()
+        write_database(visitor, database, name=header, schema=False)
+        write_output(output, visitor.iter_json(indent=2, sort_keys=True))
+        write_depfile(output + DEPFILE_EXTENSION, output,
+                _cache.get_dependencies(header, visitor.include))
+    except Exception:
+        error = traceback.format_exc()
+    else:
+        error = None
+    entries = {}
+    if not _collect:
+        # nothing is sent back, so don't keep the AST of every header
+        _cache.headers.clear()
+    elif error is None:
+        entries = dict((key, _cache.headers[key]) for key in _cache.updated)
+    return (header, entries, error)
+
+def analyze_corpus(directory, outdir, cache=None, include_headers=(),
+        exclude_headers=(), jobs=None, preprocessor='cpp'):
+    """
+        analyze all headers below *directory* using *jobs* worker
+        processes (default: number of CPUs) and write the results
+        to *outdir*. Newly parsed headers are added to the `ASTCache`
+        *cache*, which is shared with the workers; saving it is up
+        to the caller. If *cache* is None, no cache is used and the
+        headers are preprocessed with *preprocessor* (see
+        `babbisch.utils.preprocess`), otherwise with the cache's.
+
+        Return a tuple ``(analyzed, skipped, failures)``, *failures*
+        being a list of ``(header, traceback)`` tuples. They are also
+        written to `FAILURES_FILENAME` in *outdir*.
+    """
+    directory = os.path.abspath(directory)
+    database = os.path.join(outdir, DATABASE_FILENAME)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    # the workers can't create it concurrently
+    create_schema(database)
+    tasks = []
+    skipped = 0
+    for header in find_headers(directory):
+        output = os.path.join(outdir,
+                os.path.relpath(header, directory) + '.json')
+        if is_done(header, output):
+            skipped += 1
+        else:
+            tasks.append((header, output, database,
+                list(include_headers), list(exclude_headers)))
+    # start with the biggest headers, so no worker gets a big one last
+    tasks.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+
+    analyzed = 0
+    failures = []
+    pool = Pool(jobs, _init_worker, (cache, preprocessor))
+    try:
+        for header, entries, error in pool.imap_unordered(analyze_header, tasks):
+            if error is not None:
+                print >>sys.stderr, 'babbisch: failed to analyze %s' % header
+                failures.append((header, error))
+            else:
+                analyzed += 1
+                if cache is not None:
+                    cache.headers.update(entries)
+                    cache.updated.update(entries)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    with open(os.path.join(outdir, FAILURES_FILENAME), 'w') as f:
+        for header, error in failures:
+            f.write('%s\n%s\n' % (header, error))
+    return analyzed, skipped, failures
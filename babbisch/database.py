@@ -0,0 +1,268 @@
+"""
+    write the analyzed objects to a SQLite database.
+
+    Objects are deduplicated by their content and the content of
+    everything they refer to, so several runs (e.g. of libraries
+    sharing system headers) can be appended to one database.
+    Each run maps its output keys to objects in the `keys` table, type
+    references (typedef targets, pointer types, members, arguments, ...)
+    point to the referenced object's id.
+
+    Example: all functions taking a ``cairo_t *``::
+
+        SELECT DISTINCT f.name FROM objects f
+            JOIN arguments a ON a.object_id = f.id
+            JOIN objects t ON a.type_id = t.id
+        WHERE f.class = 'Function' AND t.tag = 'POINTER(cairo_t)';
+"""
+from __future__ import with_statement
+
+import hashlib
+import sqlite3
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from .analyze import (Typedef, Array, PrimitiveType, Struct, Union, Enum,
+        Pointer, Function, FunctionType)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS objects (
+    id INTEGER PRIMARY KEY,
+    signature TEXT UNIQUE NOT NULL,
+    tag TEXT NOT NULL,
+    class TEXT NOT NULL,
+    name TEXT,
+    file TEXT,
+    line INTEGER,
+    type_id INTEGER REFERENCES objects(id),
+    size INTEGER,
+    varargs INTEGER,
+    storage TEXT,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS keys (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    key TEXT NOT NULL,
+    object_id INTEGER NOT NULL REFERENCES objects(id),
+    PRIMARY KEY (run_id, key)
+);
+CREATE TABLE IF NOT EXISTS members (
+    object_id INTEGER NOT NULL REFERENCES objects(id),
+    position INTEGER NOT NULL,
+    name TEXT,
+    type_id INTEGER REFERENCES objects(id),
+    bitsize INTEGER,
+    value INTEGER,
+    PRIMARY KEY (object_id, position)
+);
+CREATE TABLE IF NOT EXISTS arguments (
+    object_id INTEGER NOT NULL REFERENCES objects(id),
+    position INTEGER NOT NULL,
+    name TEXT,
+    type_id INTEGER REFERENCES objects(id),
+    PRIMARY KEY (object_id, position)
+);
+CREATE INDEX IF NOT EXISTS runs_name ON runs (name);
+CREATE INDEX IF NOT EXISTS objects_tag ON objects (tag);
+CREATE INDEX IF NOT EXISTS objects_class_name ON objects (class, name);
+CREATE INDEX IF NOT EXISTS objects_file ON objects (file);
+CREATE INDEX IF NOT EXISTS objects_type ON objects (type_id);
+CREATE INDEX IF NOT EXISTS keys_key ON keys (key);
+CREATE INDEX IF NOT EXISTS keys_object ON keys (object_id);
+CREATE INDEX IF NOT EXISTS members_type ON members (type_id);
+CREATE INDEX IF NOT EXISTS arguments_type ON arguments (type_id);
+"""
+
+def _references(obj):
+    """
+        return the objects *obj* refers to, in the order
+        `DatabaseWriter.add_references` inserts them (None for
+        missing types).
+    """
+    if isinstance(obj, Typedef):
+        return [obj.target]
+    elif isinstance(obj, (Array, Pointer)):
+        return [obj.type]
+    elif isinstance(obj, Function):
+        return [obj.rettype] + obj.arguments.values()
+    elif isinstance(obj, FunctionType):
+        return [obj.rettype] + obj.argtypes
+    elif isinstance(obj, Struct):
+        return [typ for typ, bitsize in obj.members.values()]
+    elif isinstance(obj, Union):
+        return obj.members.values()
+    return []
+
+class DatabaseWriter(object):
+    def __init__(self, conn, objects):
+        self.conn = conn
+        self.objects = objects
+        self.ids = {} # id(obj): row id
+        self.new = [] # (row id, obj) of objects not yet in the database
+        self.states = {} # id(obj): JSON state
+        self.signatures = {} # id(obj): signature, see `signature`
+
+    def _encode(self, obj):
+        return obj.get_state(self.objects)
+
+    def _state(self, obj):
+        try:
+            return self.states[id(obj)]
+        except KeyError:
+            pass
+        state = self.states[id(obj)] = json.dumps(
+                obj.get_state(self.objects),
+                sort_keys=True,
+                default=self._encode)
+        return state
+
+    def signature(self, obj):
+        """
+            return the signature of *obj*, which identifies its row:
+            a hash of its state and the signatures of the objects it
+            refers to. The state refers to other objects by their tag,
+            and the same tag may be a different type in another run.
+            References always point to objects created before the
+            referring one (a struct referring to itself gets a new
+            Struct object), so there are no cycles.
+        """
+        try:
+            return self.signatures[id(obj)]
+        except KeyError:
+            pass
+        references = [self.signature(ref) if ref is not None else ''
+                for ref in _references(obj)]
+        signature = self.signatures[id(obj)] = hashlib.sha1('%s\n%s' % (
+                self._state(obj), ' '.join(references))).hexdigest()
+        return signature
+
+    def add(self, obj):
+        """
+            insert *obj* if there is no identical object in the
+            database yet and return its row id.
+        """
+        if obj is None:
+            return None
+        try:
+            return self.ids[id(obj)]
+        except KeyError:
+            pass
+        state = self._state(obj)
+        signature = self.signature(obj)
+        coord = obj.coord or {}
+        name = getattr(obj, 'name', None)
+        if isinstance(obj, (Typedef, PrimitiveType)):
+            name = obj.tag
+        cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO objects '
+                '(signature, tag, class, name, file, line, '
+                'size, varargs, storage, state) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (signature, obj.tag, type(obj).__name__, name,
+                 coord.get('file'), coord.get('line'),
+                 getattr(obj, 'size', None),
+                 getattr(obj, 'varargs', None),
+                 ','.join(getattr(obj, 'storage', ())) or None,
+                 state))
+        if cursor.rowcount:
+            row_id = cursor.lastrowid
+            self.new.append((row_id, obj))
+        else:
+            row_id = self.conn.execute(
+                    'SELECT id FROM objects WHERE signature = ?',
+                    (signature,)).fetchone()[0]
+        self.ids[id(obj)] = row_id
+        return row_id
+
+    def add_references(self):
+        """
+            insert members, arguments and type references of all
+            objects added since the last call, adding referenced
+            objects on the way.
+        """
+        types = []
+        members = []
+        arguments = []
+        while self.new:
+            row_id, obj = self.new.pop()
+            if isinstance(obj, Typedef):
+                types.append((self.add(obj.target), row_id))
+            elif isinstance(obj, (Array, Pointer)):
+                types.append((self.add(obj.type), row_id))
+            elif isinstance(obj, Function):
+                types.append((self.add(obj.rettype), row_id))
+                for position, (name, typ) in enumerate(obj.arguments.iteritems()):
+                    arguments.append((row_id, position, name, self.add(typ)))
+            elif isinstance(obj, FunctionType):
+                types.append((self.add(obj.rettype), row_id))
+                for position, typ in enumerate(obj.argtypes):
+                    arguments.append((row_id, position, None, self.add(typ)))
+            elif isinstance(obj, Struct):
+                for position, (name, (typ, bitsize)) in enumerate(obj.members.iteritems()):
+                    members.append((row_id, position, name, self.add(typ), bitsize, None))
+            elif isinstance(obj, Union):
+                for position, (name, typ) in enumerate(obj.members.iteritems()):
+                    members.append((row_id, position, name, self.add(typ), None, None))
+            elif isinstance(obj, Enum):
+                for position, (name, value) in enumerate(obj.members.iteritems()):
+                    members.append((row_id, position, name, None, None, value))
+        self.conn.executemany(
+                'UPDATE objects SET type_id = ? WHERE id = ?', types)
+        self.conn.executemany(
+                'INSERT INTO members VALUES (?, ?, ?, ?, ?, ?)', members)
+        self.conn.executemany(
+                'INSERT INTO arguments VALUES (?, ?, ?, ?)', arguments)
+
+def create_schema(filename, timeout=60.0):
+    """
+        create the tables of the SQLite database *filename* if they
+        don't exist yet.
+    """
+    conn = sqlite3.connect(filename, timeout=timeout)
+    try:
+        conn.executescript(SCHEMA)
+    finally:
+        conn.close()
+
+def write_database(visitor, filename, name=None, timeout=60.0, schema=True):
+    """
+        append the objects of the `AnalyzingVisitor` *visitor* as
+        a new run to the SQLite database *filename*. Everything is
+        inserted in a single transaction. If *name* is given, older
+        runs of the same name are replaced.
+
+        *timeout* is the number of seconds to wait for other processes
+        writing to the same database. If *schema* is False, the tables
+        must already exist (see `create_schema`); processes writing to
+        the same new database concurrently have to do that, because
+        creating the schema at the same time fails.
+    """
+    if schema:
+        create_schema(filename, timeout)
+    conn = sqlite3.connect(filename, timeout=timeout)
+    try:
+        with conn:
+            if name is not None:
+                conn.execute('DELETE FROM keys WHERE run_id IN '
+                        '(SELECT id FROM runs WHERE name = ?)', (name,))
+                conn.execute('DELETE FROM runs WHERE name = ?', (name,))
+            run_id = conn.execute(
+                    'INSERT INTO runs (name, created) VALUES (?, ?)',
+                    (name, time.time())).lastrowid
+            writer = DatabaseWriter(conn, visitor.objects)
+            keys = [(run_id, key, writer.add(obj))
+                    for key, obj in visitor.objects.iteritems()
+                    if visitor._include_object(obj)]
+            writer.add_references()
+            conn.executemany('INSERT INTO keys VALUES (?, ?, ?)', keys)
+    finally:
+        conn.close()
@@ -10,8 +10,45 @@ def include_exclude(include_regexes, exclude_regexes):
                     for regex in include_regexes) and not 
                 any(re.match(regex, filename)
                     for regex in exclude_regexes))
+    # used by the `ASTCache` to tell filtered ASTs apart
+    include.key = (tuple(include_regexes), tuple(exclude_regexes))
     return include
 
+def parse_linemarker(line):
+    """
+        parse the cpp linemarker *line* (``# linenum "filename" flags``)
+        and return a tuple ``(linenum, filename, flags)``.
+    """
+    splitted = shlex.split(line[1:].strip())
+    assert len(splitted) >= 2
+    if len(splitted) == 2:
+        linenum, filename = splitted
+        flags = ()
+    else:
+        linenum, filename = splitted[:2]
+        flags = splitted[2:]
+    return linenum, filename, flags
+
+def included_files(in_text):
+    """
+        return a list of all files the cpp-preprocessed string *in_text*
+        was read from, in the order they were first entered. cpp's
+        pseudo files like ``<built-in>`` are skipped.
+    """
+    files = []
+    seen = set()
+    for line in in_text.splitlines():
+        # only look at linemarkers, not at #pragma and friends
+        if not line.startswith('# ') or not line[2:3].isdigit():
+            continue
+        linenum, filename, flags = parse_linemarker(line)
+        if filename.startswith('<') and filename.endswith('>'):
+            continue
+        if filename not in seen:
+            seen.add(filename)
+            files.append(filename)
+    return files
+
 def filter_headers(in_text, include):
     """
         return a modified version of the cpp-preprocessed string *in_text*
@@ -27,14 +64,7 @@ def filter_headers(in_text, include):
         if char == '#':
             # Ooooh, line!
             line = in_text[idx:in_text.index('\n', idx)]
-            splitted = shlex.split(line[1:].strip())
-            assert len(splitted) >= 2
-            if len(splitted) == 2:
-                linenum, filename = splitted
-                flags = ()
-            else:
-                linenum, filename = splitted[:2]
-                flags = splitted[2].split(' ')
+            linenum, filename, flags = parse_linemarker(line)
             if FLAG_NEW_FILE in flags:
                 if not include(filename):
                     unwanted.append(depth)
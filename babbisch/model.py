@@ -0,0 +1,189 @@
+"""
+    a read-only, indexed object model of babbisch's JSON output.
+
+    Loading the output gives you an :class:`ObjectModel` that maps keys
+    to :class:`ModelObject` instances (read-only dicts holding the
+    object state, so ``obj['class']`` works as before). Tag references
+    like ``POINTER(STRUCT(x))`` are resolved lazily through
+    :mod:`babbisch.tag` and cached in the model.
+"""
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from .odict import odict
+from .tag import parse_string, translate
+
+# key of the canonical type index in the JSON output (see
+# `AnalyzingVisitor.resolve_types`)
+CANONICAL_TYPES_KEY = '!CanonicalTypes'
+
+def _readonly(self, *args, **kwargs):
+    raise TypeError('%s objects are read-only' % type(self).__name__)
+
+def _freeze(value):
+    """
+        convert lists (recursively) to tuples, so the loaded
+        model can't be modified by accident.
+    """
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+class ModelObject(dict):
+    """
+        the state of one object, as written by `Object.get_state`.
+        Lists are converted to tuples, and all mutating methods
+        raise a TypeError.
+    """
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __init__(self, state):
+        dict.__init__(self, ((k, _freeze(v)) for k, v in state.iteritems()))
+
+    def __repr__(self):
+        if 'class' not in self:
+            return dict.__repr__(self)
+        return '<%s "%s">' % (self['class'], self.get('tag'))
+
+class Reference(object):
+    """
+        a resolved tag that is not an object itself, e.g.
+        ``POINTER(STRUCT(x))``: *modifier* is ``'POINTER'``, *args*
+        is a tuple of resolved arguments (objects, references or
+        plain strings like array sizes).
+    """
+    def __init__(self, tag, modifier, args):
+        self.tag = tag
+        self.modifier = modifier
+        self.args = args
+
+    def __repr__(self):
+        return '<Reference "%s">' % self.tag
+
+class ObjectModel(object):
+    def __init__(self, pairs):
+        self.objects = odict()
+        self._resolved = {}
+        self._unique = []
+        self._by_class = {}
+        self._by_name = {}
+        self._by_file = {}
+        seen = set()
+        for key, state in pairs:
+            if not isinstance(state, ModelObject):
+                state = ModelObject(state)
+            self.objects[key] = state
+            if key == CANONICAL_TYPES_KEY:
+                # not an object, only available via `canonical_type`
+                continue
+            # builtins are stored under several keys (synonyms),
+            # only index them once.
+            tag = state['tag']
+            if tag in seen:
+                continue
+            seen.add(tag)
+            self._unique.append(state)
+            self._by_class.setdefault(state['class'], []).append(state)
+            self._by_name.setdefault(state.get('name', tag), []).append(state)
+            coord = state['coord']
+            if coord is not None:
+                self._by_file.setdefault(coord['file'], []).append(state)
+
+    def __getitem__(self, key):
+        return self.objects[key]
+
+    def __contains__(self, key):
+        return key in self.objects
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def iteritems(self):
+        return self.objects.iteritems()
+
+    def unique_objects(self):
+        """
+            return a list of all objects, synonyms only once.
+        """
+        return list(self._unique)
+
+    def by_class(self, cls):
+        return list(self._by_class.get(cls, ()))
+
+    def by_name(self, name):
+        return list(self._by_name.get(name, ()))
+
+    def by_file(self, filename):
+        return list(self._by_file.get(filename, ()))
+
+    def canonical_type(self, key):
+        """
+            return the entry of the canonical type index (see
+            `AnalyzingVisitor.resolve_types`) for the object *key*,
+            or None if the output has no index.
+        """
+        index = self.objects.get(CANONICAL_TYPES_KEY)
+        if index is None:
+            return None
+        return index['types'].get(key)
+
+    def resolve(self, ref):
+        """
+            resolve *ref* to an object. *ref* may be a tag string
+            (like ``signed int`` or ``POINTER(STRUCT(x))``) or an
+            inline object state. If the tag isn't a known object,
+            a :class:`Reference` is returned; inline states that
+            aren't known objects (anonymous structs and unions, which
+            all have the same tag) are returned as they are.
+        """
+        if isinstance(ref, dict):
+            tag = ref['tag']
+            if tag not in self.objects:
+                if not isinstance(ref, ModelObject):
+                    ref = ModelObject(ref)
+                return ref
+        else:
+            tag = ref
+        try:
+            return self._resolved[tag]
+        except KeyError:
+            pass
+        if tag in self.objects:
+            obj = self.objects[tag]
+        else:
+            obj = self._resolve_parsed(parse_string(tag), tag)
+        self._resolved[tag] = obj
+        return obj
+
+    def _resolve_parsed(self, parsed, tag):
+        if not isinstance(parsed, tuple):
+            # a plain identifier that is not known (array sizes,
+            # anonymous names).
+            return self.objects.get(parsed, parsed)
+        modifier, args = parsed
+        resolved = []
+        for arg in args:
+            if isinstance(arg, tuple):
+                resolved.append(self.resolve(translate(arg)))
+            else:
+                resolved.append(self.objects.get(arg, arg))
+        return Reference(tag, modifier, tuple(resolved))
+
+def loads(s):
+    """
+        load an object model from the JSON string *s*.
+    """
+    return ObjectModel(json.loads(s, object_hook=ModelObject))
+
+def load(f):
+    """
+        load an object model from the file-like object *f*.
+    """
+    return ObjectModel(json.load(f, object_hook=ModelObject))
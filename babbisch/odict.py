@@ -17,6 +17,11 @@ class odict(DictMixin):
         
     def __getitem__(self, key):
         return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    has_key = __contains__
     
     def __delitem__(self, key):
         del self._data[key]
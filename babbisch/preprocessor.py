@@ -0,0 +1,1279 @@
+"""
+    a C preprocessor written in Python, as an alternative to running
+    an external ``cpp`` for every header.
+
+    The output contains cpp-style linemarkers (``# line "file" flags``),
+    so `babbisch.filter` and pycparser handle it just like cpp output.
+    Included files are read, stripped of comments and tokenized only
+    once per process and shared by all `Preprocessor` instances, so
+    analyzing many headers including the same system headers is cheap:
+    the groups of conditionals are matched up once, the macros defined
+    by a line are parsed once, and the expansion of a line is reused as
+    long as the macros it used are the same.
+
+    Only what is needed for parsing declarations is supported: object-
+    and function-like macros (including ``#``, ``##``, variadic macros
+    and ``__VA_OPT__``), conditionals (with ``__has_include``),
+    ``#include``/``#include_next``, ``#undef``, ``#line`` (and
+    linemarkers), ``#error``/``#warning`` (printed, like cpp does) and
+    ``#pragma once``. Other directives are ignored. The predefined
+    macros are taken from the system's cpp.
+    Constructs that are not supported raise `PreprocessorError`, so
+    the output is either the same as cpp's or there is none.
+"""
+from __future__ import with_statement
+
+import glob
+import os
+import re
+import struct
+import sys
+from subprocess import Popen, PIPE
+
+FLAG_NEW_FILE = '1'
+FLAG_RETURN = '2'
+
+# the maximum line gap filled with newlines instead of a linemarker
+MAX_LINE_GAP = 8
+MAX_INCLUDE_DEPTH = 200
+
+def _default_system_dirs():
+    # the same order as gcc's default search path
+    machine = os.uname()[4]
+    # gcc's own headers (stddef.h, stdarg.h, ...)
+    dirs = sorted(glob.glob('/usr/lib/gcc/%s-*/*/include' % machine))[-1:]
+    dirs.append('/usr/local/include')
+    # Debian-style multiarch headers
+    dirs.extend(sorted(glob.glob('/usr/include/%s-*' % machine)))
+    dirs.append('/usr/include')
+    return [d for d in dirs if os.path.isdir(d)]
+
+SYSTEM_INCLUDE_DIRS = _default_system_dirs()
+# included before everything else if found in the system directories
+IMPLICIT_INCLUDES = ('stdc-predef.h',)
+
+def _default_macros():
+    sizes = {
+        'SHORT': struct.calcsize('h'),
+        'INT': struct.calcsize('i'),
+        'LONG': struct.calcsize('l'),
+        'LONG_LONG': struct.calcsize('q'),
+        'POINTER': struct.calcsize('P'),
+        'FLOAT': struct.calcsize('f'),
+        'DOUBLE': struct.calcsize('d'),
+        'SIZE_T': struct.calcsize('P'),
+        }
+    macros = {
+        '__STDC__': '1',
+        '__STDC_HOSTED__': '1',
+        '__STDC_VERSION__': '201710L', # gcc's default, gnu17
+        '__CHAR_BIT__': '8',
+        '__SCHAR_MAX__': '0x7f',
+        '__SHRT_MAX__': '%#x' % (2 ** (8 * sizes['SHORT'] - 1) - 1),
+        '__INT_MAX__': '%#x' % (2 ** (8 * sizes['INT'] - 1) - 1),
+        '__LONG_MAX__': '%#xL' % (2 ** (8 * sizes['LONG'] - 1) - 1),
+        '__LONG_LONG_MAX__': '%#xLL' % (2 ** (8 * sizes['LONG_LONG'] - 1) - 1),
+        '__SIZE_TYPE__': 'long unsigned int' if sizes['POINTER'] == sizes['LONG'] else 'unsigned int',
+        '__PTRDIFF_TYPE__': 'long int' if sizes['POINTER'] == sizes['LONG'] else 'int',
+        '__WCHAR_TYPE__': 'int',
+        '__ORDER_LITTLE_ENDIAN__': '1234',
+        '__ORDER_BIG_ENDIAN__': '4321',
+        '__BYTE_ORDER__': '__ORDER_%s_ENDIAN__' % sys.byteorder.upper(),
+        }
+    for name, size in sizes.iteritems():
+        macros['__SIZEOF_%s__' % name] = str(size)
+    if sizes['POINTER'] == 8 and sizes['LONG'] == 8:
+        macros['__LP64__'] = macros['_LP64'] = '1'
+    if sys.platform.startswith('linux'):
+        for name in ('__linux__', '__linux', '__gnu_linux__', '__unix__',
+                '__unix', '__ELF__'):
+            macros[name] = '1'
+    machine = os.uname()[4]
+    if machine in ('x86_64', 'amd64'):
+        for name in ('__x86_64__', '__x86_64', '__amd64__', '__amd64'):
+            macros[name] = '1'
+    elif re.match(r'i\d86$', machine):
+        macros['__i386__'] = macros['__i386'] = '1'
+    # the <stdint.h> types, named like gcc does
+    def unsigned(ctype):
+        if ctype == 'signed char':
+            return 'unsigned char'
+        return ctype.replace('int', 'unsigned int')
+    lp64 = sizes['POINTER'] == sizes['LONG'] == 8
+    int64 = 'long int' if sizes['LONG'] == 8 else 'long long int'
+    suffix64 = 'L' if sizes['LONG'] == 8 else 'LL'
+    types = {8: 'signed char', 16: 'short int', 32: 'int', 64: int64}
+    for bits, signed in types.iteritems():
+        suffix = suffix64 if bits == 64 else ''
+        usuffix = {32: 'U', 64: 'U' + suffix64}.get(bits, '')
+        fast = signed if bits in (8, 64) else ('long int' if lp64 else 'int')
+        for kind, ctype in (('', signed), ('_LEAST', signed), ('_FAST', fast)):
+            macros['__INT%s%d_TYPE__' % (kind, bits)] = ctype
+            macros['__UINT%s%d_TYPE__' % (kind, bits)] = unsigned(ctype)
+        macros['__INT%d_MAX__' % bits] = '%#x%s' % (2 ** (bits - 1) - 1, suffix)
+        macros['__UINT%d_MAX__' % bits] = '%#x%s' % (2 ** bits - 1, usuffix)
+        macros['__INT%d_C(c)' % bits] = 'c ## %s' % suffix if suffix else 'c'
+        macros['__UINT%d_C(c)' % bits] = 'c ## %s' % usuffix if usuffix else 'c'
+    pointer = 'long int' if sizes['POINTER'] == sizes['LONG'] else 'int'
+    macros.update({
+        '__INTMAX_TYPE__': int64,
+        '__UINTMAX_TYPE__': unsigned(int64),
+        '__INTMAX_MAX__': macros['__INT64_MAX__'],
+        '__UINTMAX_MAX__': macros['__UINT64_MAX__'],
+        '__INTMAX_C(c)': macros['__INT64_C(c)'],
+        '__UINTMAX_C(c)': macros['__UINT64_C(c)'],
+        '__INTPTR_TYPE__': pointer,
+        '__UINTPTR_TYPE__': unsigned(pointer),
+        '__CHAR16_TYPE__': 'short unsigned int',
+        '__CHAR32_TYPE__': 'unsigned int',
+        '__WINT_TYPE__': 'unsigned int',
+        '__SIG_ATOMIC_TYPE__': 'int',
+        })
+    return macros
+
+def _compiler_macros():
+    """
+        return the macros predefined by the system's cpp (run like
+        `babbisch.utils.preprocess` does, without ``__GNUC__``), or
+        None if there is no cpp.
+    """
+    try:
+        # -nostdinc leaves out stdc-predef.h, which is included anyway
+        pipe = Popen(['cpp', '-nostdinc', '-U', '__GNUC__', '-dM', '-E', os.devnull],
+                stdout=PIPE, stderr=PIPE)
+        output = pipe.communicate()[0]
+    except OSError:
+        return None
+    if pipe.returncode != 0:
+        return None
+    macros = {}
+    for line in output.splitlines():
+        # '#define NAME value' or '#define NAME(params) value'
+        words = line.split(' ', 2)
+        if len(words) > 1 and words[0] == '#define':
+            macros[words[1]] = words[2] if len(words) > 2 else ''
+    return macros
+
+# the same macros as the system's cpp if there is one
+PREDEFINED_MACROS = _compiler_macros() or _default_macros()
+
+class PreprocessorError(Exception):
+    pass
+
+# no groups, so findall returns the tokens
+_TOKEN = re.compile(r'''
+     [ \t\f\v\r]+                                   # whitespace
+    |L?"(?:[^"\\\n]|\\.)*"                          # string
+    |L?'(?:[^'\\\n]|\\.)*'                          # character
+    |\.?[0-9](?:[eEpP][+-]|[A-Za-z0-9_.])*          # number
+    |[A-Za-z_$][A-Za-z0-9_$]*                       # identifier
+    |\.\.\.|<<=|>>=|->|\+\+|--|<<|>>|<=|>=|==|!=|&&|\|\|         # punctuator
+    |\*=|/=|%=|\+=|-=|&=|\^=|\|=|\#\#|[][(){}.&*+\-~!/%<>^|?:;=,\#]
+    |.                                              # anything else
+    ''', re.X)
+_WHITESPACE = frozenset(' \t\f\v\r')
+_CALL_PUNCTUATORS = frozenset('(),')
+_IDENTIFIER = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*\Z')
+_COMMENT_OR_LITERAL = re.compile(r'''
+     //(?:[^\n\\]|\\.)*
+    |/\*.*?\*/
+    |"(?:[^"\\\n]|\\.)*"
+    |'(?:[^'\\\n]|\\.)*'
+    ''', re.X | re.S)
+# macros implemented by the preprocessor itself
+_BUILTIN_MACROS = frozenset(['__FILE__', '__LINE__', '__COUNTER__',
+    '__has_include', '__has_include_next'])
+# names `Preprocessor.expand` handles besides the defined macros
+_SPECIAL_NAMES = _BUILTIN_MACROS | frozenset(['defined'])
+_INTEGER = re.compile(r'(0[xX][0-9a-fA-F]+|[0-9]+)([uUlL]*)\Z')
+
+def tokenize(text):
+    """
+        split *text* into a list of token strings. Whitespace is
+        collapsed to single ``' '`` tokens.
+    """
+    return [' ' if token[0] in _WHITESPACE else token
+            for token in _TOKEN.findall(text)]
+
+def _is_identifier(token):
+    return _IDENTIFIER.match(token) is not None
+
+def _physical_lines(text):
+    """
+        yield ``(line number, line)`` for the lines of *text*, with all
+        comments replaced by a single space. Like cpp, a comment
+        spanning several lines doesn't end a directive: the lines are
+        joined, with the line number of the first one.
+    """
+    start = lineno = 1
+    current = []
+    directive = False # the current logical line is a directive
+    continued = False # the previous line ended with a backslash
+    pos = 0
+    for match in _COMMENT_OR_LITERAL.finditer(text):
+        found = match.group()
+        code = text[pos:match.start()]
+        pos = match.end()
+        if found[0] != '/':
+            # a string or character literal, keep it
+            code += found
+        parts = code.split('\n')
+        for part in parts[:-1]:
+            current.append(part)
+            line = ''.join(current)
+            if not continued:
+                directive = line.lstrip().startswith('#')
+            continued = line.endswith('\\')
+            yield start, line
+            lineno += 1
+            start = lineno
+            current = []
+        current.append(parts[-1])
+        if found[0] != '/':
+            continue
+        current.append(' ')
+        newlines = found.count('\n')
+        if not newlines:
+            continue
+        lineno += newlines
+        if not continued:
+            directive = ''.join(current).lstrip().startswith('#')
+        if not directive:
+            # the rest of the line is on the comment's last line
+            line = ''.join(current)
+            continued = False
+            yield start, line
+            start = lineno
+            current = []
+    for part in text[pos:].split('\n'):
+        current.append(part)
+        yield start, ''.join(current)
+        lineno += 1
+        start = lineno
+        current = []
+
+def logical_lines(text):
+    """
+        strip the comments from the C source *text*, join lines ending
+        with a backslash and return a list of ``(line number, tokens,
+        is directive)`` tuples for the resulting lines.
+    """
+    lines = []
+    pending = []
+    start = None
+    for lineno, line in _physical_lines(text.replace('\r\n', '\n')):
+        if start is None:
+            start = lineno
+        if line.endswith('\\'):
+            pending.append(line[:-1])
+            continue
+        pending.append(line)
+        tokens = tokenize(''.join(pending))
+        while tokens and tokens[0] == ' ':
+            del tokens[0]
+        while tokens and tokens[-1] == ' ':
+            del tokens[-1]
+        if tokens:
+            lines.append((start, tokens, tokens[0] == '#'))
+        pending = []
+        start = None
+    return lines
+
+_CONDITIONALS = ('if', 'ifdef', 'ifndef')
+
+def _directive(tokens):
+    """
+        split the tokens of a directive line into ``(name, rest,
+        words)``: the directive name, the (stripped) tokens after it
+        and the same without spaces. Linemarkers are ``#line``.
+    """
+    words = [t for t in tokens[1:] if t != ' ']
+    if not words:
+        return '', [], []
+    name = words[0]
+    rest = _strip(tokens[tokens.index(name, 1) + 1:])
+    if name.isdigit():
+        # a linemarker, as in already preprocessed input
+        rest = [name, ' '] + rest
+        name = 'line'
+    return name, rest, [t for t in rest if t != ' ']
+
+class SourceFile(object):
+    """
+        a tokenized file. *lines* are ``(line number, tokens,
+        directive)``, with the directive split by `_directive`, or
+        None for other lines.
+    """
+    def __init__(self, path, mtime, lines):
+        self.path = path
+        self.mtime = mtime
+        self.lines = [(lineno, tokens, _directive(tokens) if directive else None)
+                for lineno, tokens, directive in lines]
+        # line index of a conditional directive: index of the next
+        # #elif, #else or #endif of the same #if
+        self.branches = self._find_branches()
+        self.guard = self._find_guard()
+        # line index: `Macro` parsed from the #define there
+        self.definitions = {}
+        # line index: ``(dependencies, value)`` of the last text line
+        # or #if expanded there, see `Preprocessor._remember`
+        self.expansions = {}
+
+    def _find_branches(self):
+        branches = {}
+        stack = []
+        for index, (lineno, tokens, directive) in enumerate(self.lines):
+            if directive is None:
+                continue
+            name = directive[0]
+            if name in _CONDITIONALS:
+                stack.append(index)
+            elif name in ('elif', 'else') and stack:
+                branches[stack[-1]] = index
+                stack[-1] = index
+            elif name == 'endif' and stack:
+                branches[stack.pop()] = index
+        return branches
+
+    def _find_guard(self):
+        """
+            return the macro name if the whole file is wrapped in
+            ``#ifndef NAME`` ... ``#endif`` (without ``#else``),
+            otherwise None.
+        """
+        lines = self.lines
+        if len(lines) < 2 or not lines[0][2]:
+            return None
+        name, rest, words = lines[0][2]
+        if (name != 'ifndef' or len(words) != 1
+                or self.branches.get(0) != len(lines) - 1
+                or lines[-1][2][0] != 'endif'):
+            return None
+        return words[0]
+
+# path: `SourceFile`, shared by all preprocessors of this process
+_file_cache = {}
+# expanded #if expression: its value
+_condition_cache = {}
+
+def read_source(path):
+    """
+        return the `SourceFile` for *path*, reading it only if it
+        changed since the last call.
+    """
+    mtime = os.stat(path).st_mtime
+    source = _file_cache.get(path)
+    if source is None or source.mtime != mtime:
+        with open(path) as f:
+            source = SourceFile(path, mtime, logical_lines(f.read()))
+        _file_cache[path] = source
+    return source
+
+class Macro(object):
+    def __init__(self, name, body, params=None, variadic=None):
+        self.name = name
+        self.body = body
+        self.params = params # None for object-like macros
+        self.variadic = variadic # name of the variadic parameter
+        # no # or ## operators: only parameters need to be replaced
+        self.simple = ('#' not in body and '##' not in body
+                and not (variadic and '__VA_OPT__' in body))
+        # the names its expansion may look up (the arguments replacing
+        # the parameters come from the caller); ## can make up others
+        self.names = [t for t in body if _is_identifier(t)
+                and t not in (params or ())]
+        self.pastes = '##' in body
+
+class _Painted(str):
+    """
+        the name of a macro found during its own expansion, which is
+        never expanded, even when it is rescanned later.
+    """
+    __slots__ = ()
+
+def _strip(tokens):
+    start, end = 0, len(tokens)
+    while start < end and tokens[start] == ' ':
+        start += 1
+    while end > start and tokens[end - 1] == ' ':
+        end -= 1
+    return tokens[start:end]
+
+def _stringify(tokens):
+    parts = []
+    for token in _strip(tokens):
+        if token[-1:] in ('"', "'"):
+            token = token.replace('\\', '\\\\').replace('"', '\\"')
+        parts.append(token)
+    return '"%s"' % ''.join(parts)
+
+# #if expressions are evaluated in intmax_t or uintmax_t
+_INTMAX_BITS = 64
+_UINTMAX_MASK = 2 ** _INTMAX_BITS - 1
+_INTMAX_MAX = 2 ** (_INTMAX_BITS - 1) - 1
+
+def _to_type(value, unsigned):
+    """
+        return the tuple ``(value, unsigned)``, with *value* wrapped
+        around like an intmax_t or uintmax_t.
+    """
+    value &= _UINTMAX_MASK
+    if not unsigned and value > _INTMAX_MAX:
+        value -= 2 ** _INTMAX_BITS
+    return value, unsigned
+
+def _divide(a, b, unsigned):
+    if b == 0:
+        return 0
+    quotient = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        # C truncates towards zero
+        quotient = -quotient
+    return quotient
+
+def _shift(a, b):
+    # a negative count shifts the other way, like in gcc
+    if b < 0:
+        return a >> -b
+    return a << b
+
+class _ExpressionParser(object):
+    """
+        evaluate the fully expanded token list of a ``#if``. Values
+        are tuples ``(value, unsigned)``; like in C, an operation with
+        an unsigned operand converts the other one to unsigned.
+    """
+    # operator: (precedence, kind, function)
+    BINARY = {
+        '||': (1, 'logical', lambda a, b: bool(a) or bool(b)),
+        '&&': (2, 'logical', lambda a, b: bool(a) and bool(b)),
+        '|': (3, 'arithmetic', lambda a, b, u: a | b),
+        '^': (4, 'arithmetic', lambda a, b, u: a ^ b),
+        '&': (5, 'arithmetic', lambda a, b, u: a & b),
+        '==': (6, 'comparison', lambda a, b: a == b),
+        '!=': (6, 'comparison', lambda a, b: a != b),
+        '<': (7, 'comparison', lambda a, b: a < b),
+        '>': (7, 'comparison', lambda a, b: a > b),
+        '<=': (7, 'comparison', lambda a, b: a <= b),
+        '>=': (7, 'comparison', lambda a, b: a >= b),
+        '<<': (8, 'shift', _shift),
+        '>>': (8, 'shift', lambda a, b: _shift(a, -b)),
+        '+': (9, 'arithmetic', lambda a, b, u: a + b),
+        '-': (9, 'arithmetic', lambda a, b, u: a - b),
+        '*': (10, 'arithmetic', lambda a, b, u: a * b),
+        '/': (10, 'arithmetic', _divide),
+        '%': (10, 'arithmetic', lambda a, b, u: a - b * _divide(a, b, u) if b else 0),
+        }
+
+    def __init__(self, tokens):
+        self.tokens = [t for t in tokens if t != ' ']
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise PreprocessorError('unexpected end of #if expression')
+        self.pos += 1
+        return token
+
+    def evaluate(self):
+        value = self._conditional()
+        if self._peek() is not None:
+            raise PreprocessorError('unexpected %r in #if expression' % self._peek())
+        return value[0]
+
+    def _conditional(self):
+        condition = self._binary(1)
+        if self._peek() != '?':
+            return condition
+        self._next()
+        if_true = self._conditional()
+        if self._next() != ':':
+            raise PreprocessorError("expected ':' in #if expression")
+        if_false = self._conditional()
+        unsigned = if_true[1] or if_false[1]
+        return _to_type((if_true if condition[0] else if_false)[0], unsigned)
+
+    def _binary(self, min_precedence):
+        left = self._unary()
+        while True:
+            operator = self.BINARY.get(self._peek())
+            if operator is None or operator[0] < min_precedence:
+                return left
+            self._next()
+            precedence, kind, function = operator
+            right = self._binary(precedence + 1)
+            if kind == 'logical':
+                left = (int(function(left[0], right[0])), False)
+            elif kind == 'shift':
+                # the type of the left operand
+                left = _to_type(function(left[0], right[0]), left[1])
+            else:
+                unsigned = left[1] or right[1]
+                a = _to_type(left[0], unsigned)[0]
+                b = _to_type(right[0], unsigned)[0]
+                if kind == 'comparison':
+                    left = (int(function(a, b)), False)
+                else:
+                    left = _to_type(function(a, b, unsigned), unsigned)
+
+    def _unary(self):
+        token = self._next()
+        if token in ('+', '-', '~'):
+            value, unsigned = self._unary()
+            if token == '-':
+                value = -value
+            elif token == '~':
+                value = ~value
+            return _to_type(value, unsigned)
+        elif token == '!':
+            return (int(not self._unary()[0]), False)
+        elif token == '(':
+            value = self._conditional()
+            if self._next() != ')':
+                raise PreprocessorError("expected ')' in #if expression")
+            return value
+        elif token[-1:] == "'":
+            return (_char_value(token), False)
+        match = _INTEGER.match(token)
+        if match is None:
+            raise PreprocessorError('unexpected %r in #if expression' % token)
+        digits = match.group(1)
+        if digits[:2].lower() == '0x':
+            value = int(digits, 16)
+        elif digits.startswith('0') and len(digits) > 1:
+            value = int(digits, 8)
+        else:
+            value = int(digits)
+        # too big for intmax_t means unsigned
+        unsigned = 'u' in match.group(2).lower() or value > _INTMAX_MAX
+        return _to_type(value, unsigned)
+
+def _char_value(token):
+    body = token[token.index("'") + 1:-1]
+    if not body.startswith('\\'):
+        return ord(body[0])
+    escape = body[1:]
+    simple = {'n': 10, 't': 9, 'r': 13, '0': 0, 'a': 7, 'b': 8,
+            'f': 12, 'v': 11, '\\': 92, "'": 39, '"': 34, '?': 63}
+    if escape[0] == 'x':
+        return int(escape[1:], 16)
+    elif escape[0].isdigit():
+        return int(escape, 8)
+    return simple.get(escape, ord(escape[0]))
+
+class Preprocessor(object):
+    """
+        preprocess one translation unit. *include_dirs* are searched
+        before *system_dirs* for both ``#include "..."`` and
+        ``#include <...>``, like cpp's ``-isystem``.
+    """
+    # `PREDEFINED_MACROS` as `Macro` objects, parsed once
+    _predefined = None
+
+    def __init__(self, include_dirs=(), system_dirs=None, macros=None):
+        if system_dirs is None:
+            system_dirs = SYSTEM_INCLUDE_DIRS
+        self.search_path = list(include_dirs) + list(system_dirs)
+        self.macros = {}
+        if macros is None and Preprocessor._predefined is not None:
+            self.macros.update(Preprocessor._predefined)
+        else:
+            if macros is None:
+                macros = PREDEFINED_MACROS
+            for name, value in macros.iteritems():
+                self.define('%s %s' % (name, value))
+            if macros is PREDEFINED_MACROS:
+                Preprocessor._predefined = dict(self.macros)
+        self.once = set()
+        self.included = set()
+        self.counter = 0 # the next value of __COUNTER__
+        # (file, search path index) while evaluating its #if
+        self.condition = None
+        self.depth = 0
+        self.filename = None
+        self.lineno = 0
+
+    def define(self, definition):
+        """
+            define a macro from *definition*, which looks like the
+            rest of a ``#define`` line, e.g. ``MAX(a, b) ((a) > (b) ? (a) : (b))``.
+        """
+        self._define(_strip(tokenize(definition)))
+
+    def _define(self, tokens):
+        if not tokens or not _is_identifier(tokens[0]):
+            raise PreprocessorError('%s:%d: invalid #define' % (self.filename, self.lineno))
+        name = tokens[0]
+        if len(tokens) > 1 and tokens[1] == '(':
+            # function-like macro: parse the parameter list
+            params = []
+            variadic = None
+            pos = 2
+            while True:
+                while tokens[pos] == ' ':
+                    pos += 1
+                token = tokens[pos]
+                pos += 1
+                if token == ')':
+                    break
+                elif token == ',':
+                    continue
+                elif token == '...':
+                    variadic = '__VA_ARGS__'
+                    params.append(variadic)
+                elif _is_identifier(token):
+                    params.append(token)
+                    if tokens[pos:pos + 1] == ['...']:
+                        # GNU named variadic parameter
+                        variadic = token
+                        pos += 1
+                else:
+                    raise PreprocessorError('%s:%d: invalid macro parameter %r'
+                            % (self.filename, self.lineno, token))
+            macro = Macro(name, _strip(tokens[pos:]), params, variadic)
+        else:
+            macro = Macro(name, _strip(tokens[1:]))
+        self.macros[name] = macro
+        return macro
+
+    def undef(self, name):
+        self.macros.pop(name, None)
+
+    def is_defined(self, name):
+        return name in self.macros or name in _BUILTIN_MACROS
+
+    def _remember(self, tokens, value):
+        """
+            return a ``(dependencies, value)`` memo for the expansion
+            *value* of *tokens*, or None if it can't be reused. The
+            dependencies are the names the expansion may have looked
+            up, with the macros they were bound to; as long as these
+            are the same, expanding *tokens* again gives *value*.
+            Expansions that use ## or built-in macros aren't
+            remembered, as they depend on more than that.
+        """
+        macros = self.macros
+        dependencies = {}
+        names = [t for t in tokens if _is_identifier(t)]
+        while names:
+            name = names.pop()
+            if name in dependencies:
+                continue
+            if name in _BUILTIN_MACROS:
+                return None
+            macro = dependencies[name] = macros.get(name)
+            if macro is not None:
+                if macro.pastes:
+                    return None
+                names.extend(macro.names)
+        return dependencies, value
+
+    def _recall(self, memo):
+        """
+            return the value of the *memo* made by `_remember`, or
+            None if one of its macros changed since.
+        """
+        get = self.macros.get
+        for name, macro in memo[0].iteritems():
+            if get(name) is not macro:
+                return None
+        return memo[1]
+
+    # -- macro expansion --------------------------------------------------
+
+    def expand(self, tokens, more=None, disabled=None):
+        """
+            return the fully macro-expanded version of *tokens*. If
+            the tokens end within a call of a function-like macro (or
+            with its name), *more* is called to get the tokens of the
+            following line, or None if there are none. *disabled* is
+            the set of the names of the macros being expanded, given
+            when expanding macro arguments.
+        """
+        macros = self.macros
+        for token in tokens:
+            if token in macros or token in _SPECIAL_NAMES:
+                break
+        else:
+            # most lines don't use any macros
+            return list(tokens)
+        top = disabled is None
+        if top:
+            disabled = set()
+        out = []
+        append = out.append
+        # the expansions being read, innermost last, as lists of
+        # ``[tokens, position, macro name]``. A macro is disabled
+        # until its expansion has been read completely.
+        context = [tokens, 0, None]
+        contexts = [context]
+        current = tokens
+        pos = 0
+        while True:
+            if pos == len(current):
+                if len(contexts) == 1:
+                    return out
+                disabled.discard(contexts.pop()[2])
+                context = contexts[-1]
+                current, pos = context[0], context[1]
+                continue
+            token = current[pos]
+            pos += 1
+            macro = macros.get(token)
+            if macro is None:
+                if token in _SPECIAL_NAMES:
+                    context[1] = pos
+                    token = self._builtin(token, contexts, disabled, top)
+                    context = contexts[-1]
+                    current, pos = context[0], context[1]
+                append(token)
+                continue
+            if token.__class__ is _Painted:
+                append(token)
+                continue
+            if token in disabled:
+                append(_Painted(token))
+                continue
+            context[1] = pos
+            if macro.params is None:
+                if macro.simple:
+                    body = macro.body
+                else:
+                    body = self._substitute(macro, {}, disabled)
+            elif self._find_paren(contexts, disabled, more):
+                args = self._collect_args(contexts, disabled, macro, more)
+                body = self._substitute(macro, args, disabled)
+            else:
+                # just the name
+                append(token)
+                context = contexts[-1]
+                current, pos = context[0], context[1]
+                continue
+            disabled.add(token)
+            context = [body, 0, token]
+            contexts.append(context)
+            current = body
+            pos = 0
+
+    def _builtin(self, token, contexts, disabled, top):
+        """
+            return the replacement of the built-in macro or ``defined``
+            *token*, reading its operand from *contexts*. Like in cpp,
+            ``defined`` is evaluated in the ``#if`` expression itself
+            (*top*), not while expanding macro arguments.
+        """
+        if token == '__LINE__':
+            return str(self.lineno)
+        elif token == '__FILE__':
+            return '"%s"' % self.filename
+        elif token == '__COUNTER__':
+            self.counter += 1
+            return str(self.counter - 1)
+        elif token == 'defined':
+            if self.condition is None or not top:
+                return token
+            name = self._next_token(contexts, disabled)
+            parenthesized = name == '('
+            if parenthesized:
+                name = self._next_token(contexts, disabled)
+            if (name is None or not _is_identifier(name) or (parenthesized
+                    and self._next_token(contexts, disabled) != ')')):
+                raise PreprocessorError('%s:%d: operator "defined" requires an identifier'
+                        % (self.filename, self.lineno))
+            return '1' if self.is_defined(name) else '0'
+        # __has_include(header) and __has_include_next(header)
+        if self.condition is None:
+            raise PreprocessorError('%s:%d: %s used outside of #if'
+                    % (self.filename, self.lineno, token))
+        if self._next_token(contexts, disabled) != '(':
+            raise PreprocessorError("%s:%d: missing '(' after %s"
+                    % (self.filename, self.lineno, token))
+        header = []
+        while True:
+            next_token = self._next_token(contexts, disabled)
+            if next_token is None:
+                raise PreprocessorError("%s:%d: missing ')' after %s"
+                        % (self.filename, self.lineno, token))
+            elif next_token == ')':
+                break
+            header.append(next_token)
+        name, quoted = self._header_name(header, disabled)
+        current, found_in = self.condition
+        path, index = self._find_header(name, quoted, current, found_in,
+                token == '__has_include_next')
+        return '0' if path is None else '1'
+
+    def _next_token(self, contexts, disabled):
+        """
+            return the next token from *contexts* which isn't a space,
+            without expanding it, or None at the end.
+        """
+        while True:
+            context = contexts[-1]
+            tokens, pos = context[0], context[1]
+            while pos < len(tokens) and tokens[pos] == ' ':
+                pos += 1
+            if pos < len(tokens):
+                context[1] = pos + 1
+                return tokens[pos]
+            context[1] = pos
+            if len(contexts) == 1:
+                return None
+            disabled.discard(contexts.pop()[2])
+
+    def _find_paren(self, contexts, disabled, more):
+        """
+            skip to the '(' after the name of a function-like macro,
+            leaving finished expansions in *contexts* and reading more
+            lines (see `expand`) on the way. Return True if it's there.
+        """
+        while True:
+            context = contexts[-1]
+            tokens, pos = context[0], context[1]
+            while pos < len(tokens) and tokens[pos] == ' ':
+                pos += 1
+            if pos < len(tokens):
+                if tokens[pos] != '(':
+                    return False
+                context[1] = pos + 1
+                return True
+            if len(contexts) > 1:
+                disabled.discard(contexts.pop()[2])
+                continue
+            following = more() if more is not None else None
+            if following is None:
+                return False
+            # the '(' may be on the next line
+            context[0] = [' '] + following
+            context[1] = 0
+
+    def _collect_args(self, contexts, disabled, macro, more=None):
+        """
+            read the arguments of a macro call (after the '(') from
+            *contexts* like `_find_paren`. Return a dict mapping
+            parameter names to token lists.
+        """
+        arg = []
+        args = [arg]
+        depth = 0
+        context = contexts[-1]
+        tokens, pos = context[0], context[1]
+        while True:
+            if pos == len(tokens):
+                if len(contexts) > 1:
+                    disabled.discard(contexts.pop()[2])
+                else:
+                    following = more() if more is not None else None
+                    if following is None:
+                        raise PreprocessorError('%s:%d: unterminated call of macro %s'
+                                % (self.filename, self.lineno, macro.name))
+                    context[0] = [' '] + following
+                    context[1] = 0
+                context = contexts[-1]
+                tokens, pos = context[0], context[1]
+                continue
+            token = tokens[pos]
+            pos += 1
+            if token not in _CALL_PUNCTUATORS:
+                arg.append(token)
+                continue
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                if depth == 0:
+                    break
+                depth -= 1
+            elif (depth == 0
+                    and not (macro.variadic and len(args) == len(macro.params))):
+                arg = []
+                args.append(arg)
+                continue
+            arg.append(token)
+        context[1] = pos
+        args = [_strip(arg) for arg in args]
+        params = macro.params
+        if len(params) == 0 and args == [[]]:
+            args = []
+        elif macro.variadic and len(args) == len(params) - 1:
+            args.append([])
+        if len(args) != len(params):
+            raise PreprocessorError('%s:%d: macro %s takes %d arguments, %d given'
+                    % (self.filename, self.lineno, macro.name, len(params), len(args)))
+        return dict(zip(params, args))
+
+    def _substitute(self, macro, args, disabled, body=None, expanded=None):
+        """
+            return the *body* (by default the whole body) of *macro*
+            with the arguments *args* put in. *expanded* caches the
+            expanded arguments.
+        """
+        if body is None:
+            body = macro.body
+        if expanded is None:
+            expanded = {}
+        out = []
+        if macro.simple:
+            for token in body:
+                if token in args:
+                    tokens = expanded.get(token)
+                    if tokens is None:
+                        tokens = expanded[token] = self.expand(
+                                args[token], None, disabled)
+                    out.extend(tokens)
+                else:
+                    out.append(token)
+            return out
+        pos = 0
+        while pos < len(body):
+            token = body[pos]
+            if token == '#' and macro.params is not None:
+                # stringification
+                pos += 1
+                while pos < len(body) and body[pos] == ' ':
+                    pos += 1
+                if pos < len(body) and body[pos] in args:
+                    out.append(_stringify(args[body[pos]]))
+                    pos += 1
+                    continue
+                if body[pos:pos + 1] == ['__VA_OPT__'] and macro.variadic:
+                    raise PreprocessorError('%s:%d: # __VA_OPT__ is not supported'
+                            % (self.filename, self.lineno))
+                out.append(token)
+                continue
+            if token == '##':
+                # token pasting: join the previous and the next token
+                pos += 1
+                while pos < len(body) and body[pos] == ' ':
+                    pos += 1
+                while out and out[-1] == ' ':
+                    out.pop()
+                if pos >= len(body):
+                    break
+                right = body[pos]
+                pos += 1
+                if right == '__VA_OPT__' and macro.variadic:
+                    raise PreprocessorError('%s:%d: ## __VA_OPT__ is not supported'
+                            % (self.filename, self.lineno))
+                if right in args:
+                    right_tokens = list(args[right])
+                    if (not right_tokens and right == macro.variadic
+                            and out and out[-1] == ','):
+                        # GNU comma elision for `, ## __VA_ARGS__`
+                        out.pop()
+                        continue
+                else:
+                    right_tokens = [right]
+                if out and right_tokens:
+                    pasted = tokenize(out.pop() + right_tokens[0])
+                    right_tokens = pasted + right_tokens[1:]
+                out.extend(right_tokens)
+                continue
+            if token in args:
+                # arguments are expanded on their own, unless they are
+                # an operand of ##
+                next_pos = pos + 1
+                while next_pos < len(body) and body[next_pos] == ' ':
+                    next_pos += 1
+                if next_pos < len(body) and body[next_pos] == '##':
+                    out.extend(args[token])
+                else:
+                    if token not in expanded:
+                        expanded[token] = self.expand(args[token], None, disabled)
+                    out.extend(expanded[token])
+                pos += 1
+                continue
+            if token == '__VA_OPT__' and macro.variadic:
+                pos = self._va_opt(macro, args, disabled, body, pos,
+                        expanded, out)
+                continue
+            out.append(token)
+            pos += 1
+        return out
+
+    def _va_opt(self, macro, args, disabled, body, pos, expanded, out):
+        """
+            substitute ``__VA_OPT__(tokens)`` at *pos* of *body* into
+            *out*: the tokens are only used if the expanded variable
+            arguments aren't empty. Return the position after it.
+        """
+        start = pos + 1
+        while start < len(body) and body[start] == ' ':
+            start += 1
+        depth = 0
+        for end in xrange(start, len(body)):
+            if body[end] == '(':
+                depth += 1
+            elif body[end] == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+        if start == len(body) or body[start] != '(' or depth != 0:
+            raise PreprocessorError('%s:%d: invalid __VA_OPT__ in macro %s'
+                    % (self.filename, self.lineno, macro.name))
+        following = [t for t in body[end + 1:] if t != ' '][:1]
+        if following == ['##']:
+            raise PreprocessorError('%s:%d: __VA_OPT__ ## is not supported'
+                    % (self.filename, self.lineno))
+        variadic = macro.variadic
+        if variadic not in expanded:
+            expanded[variadic] = self.expand(args[variadic], None, disabled)
+        if _strip(expanded[variadic]):
+            out.extend(self._substitute(macro, args, disabled,
+                body[start + 1:end], expanded))
+        return end + 1
+
+    # -- directives -------------------------------------------------------
+
+    def _eval_condition(self, tokens, current, found_in):
+        """
+            evaluate the ``#if`` expression *tokens* of the file
+            *current*, found at index *found_in* of the search path.
+        """
+        self.condition = (current, found_in)
+        try:
+            expanded = tuple(self.expand(tokens))
+        finally:
+            self.condition = None
+        value = _condition_cache.get(expanded)
+        if value is None:
+            # remaining identifiers evaluate to 0
+            tokens = ['0' if _is_identifier(t) else t for t in expanded]
+            try:
+                value = _ExpressionParser(tokens).evaluate()
+            except PreprocessorError, e:
+                raise PreprocessorError('%s:%d: %s' % (self.filename, self.lineno, e))
+            _condition_cache[expanded] = value
+        return value
+
+    def find_include(self, name, quoted, current, start=None,
+            found_in=None):
+        """
+            look up the header *name* and return a tuple ``(path,
+            index in the search path)``. Quoted includes are looked up
+            relative to the directory of *current* first; headers found
+            there get the index *found_in* of *current*, and absolute
+            paths an index of None. If *start* is given, the search
+            starts at that index of the search path (for
+            ``#include_next``). Return ``(None, None)`` if the header
+            can't be found.
+        """
+        if os.path.isabs(name):
+            if os.path.isfile(name):
+                return name, None
+            return None, None
+        if quoted and start is None:
+            path = os.path.join(os.path.dirname(current), name)
+            if os.path.isfile(path):
+                # in the same directory as the includer, so
+                # #include_next continues where it would
+                return os.path.normpath(path), found_in
+        for index in xrange(start or 0, len(self.search_path)):
+            path = os.path.join(self.search_path[index], name)
+            if os.path.isfile(path):
+                return os.path.normpath(path), index
+        return None, None
+
+    def _header_name(self, tokens, disabled=None):
+        """
+            return ``(name, quoted)`` for the header named by *tokens*,
+            which are macro-expanded unless they are ``"name"`` or
+            ``<name>``.
+        """
+        tokens = _strip(tokens)
+        if tokens and tokens[0][:1] not in ('"', '<'):
+            tokens = _strip(self.expand(tokens, None, disabled))
+        text = ''.join(tokens)
+        if text.startswith('"') and text.endswith('"'):
+            return text[1:-1], True
+        elif text.startswith('<') and text.endswith('>'):
+            return text[1:-1], False
+        raise PreprocessorError('%s:%d: invalid header name %s'
+                % (self.filename, self.lineno, text))
+
+    def _find_header(self, name, quoted, current, found_in, include_next):
+        """
+            `find_include` for an ``#include`` (or ``#include_next``)
+            in *current*, found at index *found_in* of the search path.
+        """
+        start = None
+        if include_next:
+            # continue after the directory the current file was found
+            # in, like cpp (or search everything, if it wasn't found
+            # in the search path)
+            start = 0 if found_in is None else found_in + 1
+        return self.find_include(name, quoted, current, start, found_in)
+
+    def _include(self, tokens, out, current, found_in, include_next=False):
+        """
+            process the header named by the ``#include`` arguments
+            *tokens*. *current* is the including file, *found_in* the
+            index of the search path directory it was found in.
+            Return False if the header was skipped.
+        """
+        name, quoted = self._header_name(tokens)
+        path, index = self._find_header(name, quoted, current, found_in,
+                include_next)
+        if path is None:
+            raise PreprocessorError('%s:%d: %s: No such file or directory'
+                    % (self.filename, self.lineno, name))
+        source = read_source(path)
+        # like cpp, only skip files that were included before, so
+        # they are still listed as dependencies
+        if path in self.once or (path in self.included
+                and source.guard is not None
+                and source.guard in self.macros):
+            return False
+        self._process(source, out, FLAG_NEW_FILE, index)
+        return True
+
+    def _process(self, source, out, flag=None, found_in=None):
+        self.depth += 1
+        if self.depth > MAX_INCLUDE_DEPTH:
+            raise PreprocessorError('%s: #include nested too deeply' % source.path)
+        path = source.path
+        self.included.add(path)
+        if flag is None:
+            out.append('# 1 "%s"\n' % path)
+        else:
+            out.append('# 1 "%s" %s\n' % (path, flag))
+        # the presumed filename and line number offset, changed by
+        # #line directives and linemarkers in the input
+        filename = path
+        delta = 0
+        expected = 1
+        # the number of open #if groups; the lines of groups that
+        # are not taken are skipped
+        depth = 0
+        lines = source.lines
+        branches = source.branches
+        expansions = source.expansions
+        # the index of the next line, in a list so `more` can change it
+        cursor = [0]
+        def more():
+            # the next line, if a macro call continues there
+            index = cursor[0]
+            if index < len(lines) and lines[index][2] is None:
+                cursor[0] += 1
+                return lines[index][1]
+            return None
+        while cursor[0] < len(lines):
+            index = cursor[0]
+            lineno, tokens, directive = lines[index]
+            cursor[0] += 1
+            self.filename, self.lineno = filename, lineno + delta
+            if directive is None:
+                gap = lineno + delta - expected
+                if 0 < gap <= MAX_LINE_GAP:
+                    out.append('\n' * gap)
+                elif gap != 0:
+                    out.append('# %d "%s"\n' % (lineno + delta, filename))
+                # system headers are expanded again and again with the
+                # same macros, so the last expansion is reused
+                memo = expansions.get(index)
+                text = memo and self._recall(memo)
+                if not text:
+                    text = ''.join(self.expand(tokens, more)) + '\n'
+                    if cursor[0] == index + 1:
+                        # the call didn't continue on the next line
+                        expansions[index] = self._remember(tokens, text)
+                out.append(text)
+                expected = lineno + delta + 1
+                continue
+            name, rest, words = directive
+            if name in _CONDITIONALS:
+                # find the group that is taken, if any
+                while True:
+                    if name == 'if' or name == 'elif':
+                        memo = expansions.get(index)
+                        taken = memo and self._recall(memo)
+                        if taken is None:
+                            taken = self._eval_condition(rest, path, found_in)
+                            expansions[index] = self._remember(rest, taken)
+                    elif name == 'ifdef' or name == 'ifndef':
+                        taken = self.is_defined(words[0]) == (name == 'ifdef')
+                    else:
+                        taken = name == 'else'
+                    if taken or name == 'endif':
+                        break
+                    index = branches.get(index)
+                    if index is None:
+                        raise PreprocessorError('%s:%d: unterminated #%s'
+                                % (path, lineno, name))
+                    lineno, tokens, directive = lines[index]
+                    name, rest, words = directive
+                    self.lineno = lineno + delta
+                cursor[0] = index + 1
+                if name != 'endif':
+                    depth += 1
+            elif name in ('elif', 'else', 'endif'):
+                if depth == 0:
+                    raise PreprocessorError('%s:%d: #%s without #if' % (path, lineno, name))
+                # the end of the group that was taken: skip to #endif
+                while name != 'endif':
+                    index = branches.get(index)
+                    if index is None:
+                        raise PreprocessorError('%s:%d: unterminated #%s'
+                                % (path, lineno, name))
+                    name = lines[index][2][0]
+                cursor[0] = index + 1
+                depth -= 1
+            elif name == 'define':
+                # Macro objects aren't changed, so they can be shared
+                macro = source.definitions.get(index)
+                if macro is None:
+                    source.definitions[index] = self._define(rest)
+                else:
+                    self.macros[macro.name] = macro
+            elif name == 'undef':
+                self.undef(words[0])
+            elif name in ('include', 'include_next'):
+                if self._include(rest, out, path, found_in,
+                        name == 'include_next'):
+                    out.append('# %d "%s" %s\n'
+                            % (lineno + delta + 1, filename, FLAG_RETURN))
+                    expected = lineno + delta + 1
+            elif name == 'line':
+                words = [t for t in self.expand(rest) if t != ' ']
+                if not words or not words[0].isdigit():
+                    raise PreprocessorError('%s:%d: invalid #line' % (self.filename, self.lineno))
+                delta = int(words[0]) - lineno - 1
+                if len(words) > 1:
+                    filename = words[1][1:-1]
+                out.append('# %s\n' % ' '.join([words[0], '"%s"' % filename] + words[2:]))
+                expected = lineno + delta + 1
+            elif name == 'pragma':
+                if words[:1] == ['once']:
+                    self.once.add(path)
+            elif name == 'error':
+                # cpp goes on too, and its output is used anyway
+                print >>sys.stderr, '%s:%d: error: %s' % (path, lineno, ''.join(rest))
+            elif name == 'warning':
+                print >>sys.stderr, '%s:%d: warning: %s' % (path, lineno, ''.join(rest))
+        if depth:
+            raise PreprocessorError('%s: unterminated #if' % path)
+        self.depth -= 1
+
+    def preprocess(self, filename, includes=()):
+        """
+            return the preprocessed contents of *filename*. The files
+            in *includes* are processed first, like cpp's ``-include``.
+        """
+        out = []
+        path = os.path.abspath(filename)
+        implicit = [self.find_include(name, False, path)
+                for name in IMPLICIT_INCLUDES]
+        includes = ([found for found in implicit if found[0] is not None]
+                + [(os.path.abspath(include), None) for include in includes])
+        if includes:
+            out.append('# 1 "%s"\n' % path)
+        for include, index in includes:
+            self._process(read_source(include), out, FLAG_NEW_FILE, index)
+            out.append('# 1 "%s" %s\n' % (path, FLAG_RETURN))
+        self._process(read_source(path), out)
+        return ''.join(out)
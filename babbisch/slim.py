@@ -0,0 +1,141 @@
+"""
+    a compact representation of pycparser ASTs for the header cache.
+
+    Only the top-level declarations that are included (according to an
+    include function, see `babbisch.filter.include_exclude`) or that
+    define a name those use (transitively) are kept. Nodes are
+    stored as tuples ``(class name, file index, line, attribute names,
+    values...)``, filenames are stored once per AST.
+"""
+
+from pycparser import c_ast
+from pycparser.plyparser import Coord
+
+# canonical attribute name tuples, so pickle stores each one only once
+_ATTRIBUTE_NAMES = {}
+
+def _collect_names(node, defined, used):
+    """
+        add the names the top-level declaration *node* (re)defines
+        to the set *defined* and the names it refers to to *used*.
+        Struct, union and enum names are stored as ``(class name, name)``
+        tuples, because they live in their own namespace. Referring to
+        a struct, union or enum adds it to the known objects, so it
+        counts as a definition.
+    """
+    if isinstance(node, (c_ast.Decl, c_ast.Typedef, c_ast.FuncDef)):
+        name = node.decl.name if isinstance(node, c_ast.FuncDef) else node.name
+        if name is not None:
+            defined.add(name)
+    _collect_type_names(node, defined, used)
+
+def _collect_type_names(node, defined, used):
+    if isinstance(node, (c_ast.Struct, c_ast.Union, c_ast.Enum)):
+        if node.name is not None:
+            defined.add((type(node).__name__, node.name))
+    elif isinstance(node, c_ast.IdentifierType):
+        used.update(node.names)
+    for child in node.children():
+        _collect_type_names(child, defined, used)
+
+def reachable_decls(ast, include):
+    """
+        return a list of the top-level declarations of the `FileAST`
+        *ast* whose file is included by *include*, plus (transitively)
+        all declarations defining a name they use or define. This keeps
+        everything the analysis of the included declarations depends
+        on, and keeps redeclarations in their original order.
+    """
+    decls = ast.ext or []
+    names = []
+    by_name = {} # name: [indices of decls defining it]
+    for index, decl in enumerate(decls):
+        defined = set()
+        used = set()
+        _collect_names(decl, defined, used)
+        names.append(defined | used)
+        for name in defined:
+            by_name.setdefault(name, []).append(index)
+    keep = [False] * len(decls)
+    stack = [index for index, decl in enumerate(decls)
+            if decl.coord is None or include(decl.coord.file)]
+    while stack:
+        index = stack.pop()
+        if keep[index]:
+            continue
+        keep[index] = True
+        for name in names[index]:
+            stack.extend(by_name.get(name, ()))
+    return [decl for index, decl in enumerate(decls) if keep[index]]
+
+def _encode(node, files):
+    coord = node.coord
+    if coord is None:
+        file_index = line = None
+    else:
+        file_index = files.setdefault(coord.file, len(files))
+        line = coord.line
+    # pycparser sets some attributes after creating the node, so
+    # store all of them.
+    attributes = node.__dict__.copy()
+    del attributes['coord']
+    attribute_names = tuple(sorted(attributes))
+    attribute_names = _ATTRIBUTE_NAMES.setdefault(attribute_names, attribute_names)
+    encoded = [type(node).__name__, file_index, line, attribute_names]
+    for name in attribute_names:
+        value = attributes[name]
+        if isinstance(value, c_ast.Node):
+            value = _encode(value, files)
+        elif isinstance(value, list):
+            value = [_encode(v, files) if isinstance(v, c_ast.Node) else v
+                    for v in value]
+        encoded.append(value)
+    return tuple(encoded)
+
+def _decode(encoded, files):
+    node = object.__new__(getattr(c_ast, encoded[0]))
+    attributes = node.__dict__
+    for name, value in zip(encoded[3], encoded[4:]):
+        if isinstance(value, tuple):
+            value = _decode(value, files)
+        elif isinstance(value, list):
+            value = [_decode(v, files) if isinstance(v, tuple) else v
+                    for v in value]
+        attributes[name] = value
+    coord = None
+    if encoded[1] is not None:
+        coord = Coord(files[encoded[1]], encoded[2])
+    attributes['coord'] = coord
+    return node
+
+def slim_ast(ast, include=None):
+    """
+        return the compact representation of the `FileAST` *ast*. If
+        *include* is not None, only keep the declarations returned by
+        `reachable_decls`.
+    """
+    if include is None:
+        decls = ast.ext or []
+    else:
+        decls = reachable_decls(ast, include)
+    files = {}
+    encoded = tuple(_encode(decl, files) for decl in decls)
+    file_list = [None] * len(files)
+    for filename, index in files.iteritems():
+        file_list[index] = filename
+    return (tuple(file_list), encoded)
+
+def iter_decls(slimmed):
+    """
+        yield the top-level declarations of the result of `slim_ast`,
+        building each one only when it is requested.
+    """
+    files, encoded = slimmed
+    for decl in encoded:
+        yield _decode(decl, files)
+
+def expand_ast(slimmed):
+    """
+        build a `FileAST` from the result of `slim_ast`.
+    """
+    return c_ast.FileAST(list(iter_decls(slimmed)))
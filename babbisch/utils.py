@@ -1,4 +1,5 @@
 from __future__ import with_statement
+import hashlib
 import os
 import sys
 from subprocess import Popen, PIPE
@@ -13,71 +14,249 @@ except ImportError:
 from pycparser import CParser
 from pycparser.plyparser import ParseError
 
+from .filter import included_files
+from .preprocessor import Preprocessor
+from .slim import slim_ast, expand_ast, iter_decls
+
 CACHE_FILENAME = 'header.cache'
+CACHE_VERSION = 5
 HEADER_REPLACEMENTS = resource_filename('babbisch', 'headers')
+PREPROCESSORS = ('cpp', 'python')
+
+def file_digest(filename):
+    """
+        return the SHA-1 hexdigest of the contents of *filename*, or
+        None if it can't be read.
+    """
+    digest = hashlib.sha1()
+    try:
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(65536), ''):
+                digest.update(block)
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+def write_file(filename, chunks, only_if_changed=False):
+    """
+        write the strings from the iterable *chunks* to *filename*
+        atomically: the file either has the old or the new contents,
+        even if we are interrupted. If *only_if_changed* is True, an
+        existing file with the same contents is left alone (keeping
+        its mtime).
+
+        Return a tuple ``(written, SHA-1 hexdigest of the contents)``.
+    """
+    digest = hashlib.sha1()
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        with open(tmp_filename, 'w') as f:
+            for chunk in chunks:
+                digest.update(chunk)
+                f.write(chunk)
+        hexdigest = digest.hexdigest()
+        if only_if_changed and file_digest(filename) == hexdigest:
+            os.remove(tmp_filename)
+            return False, hexdigest
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return True, hexdigest
+
+def newest_mtime(filenames):
+    """
+        return the most recent mtime of the files *filenames*, or
+        None if one of them doesn't exist.
+    """
+    mtime = 0
+    for filename in filenames:
+        try:
+            mtime = max(mtime, os.stat(filename).st_mtime)
+        except OSError:
+            return None
+    return mtime
+
+def _escape_make(filename):
+    return filename.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+def _unescape_make(filename):
+    return filename.replace('\\ ', ' ').replace('\\#', '#').replace('$$', '$')
+
+def write_depfile(filename, target, dependencies):
+    """
+        write a make rule stating that *target* depends on
+        *dependencies* to *filename*, like ``gcc -MD`` does.
+    """
+    seen = set()
+    lines = ['%s:' % _escape_make(target)]
+    for dependency in dependencies:
+        if dependency not in seen:
+            seen.add(dependency)
+            lines.append(' %s' % _escape_make(dependency))
+    write_file(filename, [' \\\n'.join(lines) + '\n'], only_if_changed=True)
+
+def read_depfile(filename):
+    """
+        return the dependencies from a file written by `write_depfile`,
+        or None if it can't be read.
+    """
+    try:
+        with open(filename) as f:
+            text = f.read()
+    except IOError:
+        return None
+    if text.endswith('\n'):
+        text = text[:-1]
+    # every dependency is on its own line, indented by one space
+    return [_unescape_make(line[1:]) for line in text.split(' \\\n')[1:]]
 
-def parse_file(filename, use_cpp=True):
-    if use_cpp:
+def preprocess(filename, use_cpp=True, preprocessor='cpp'):
+    """
+        return the contents of *filename*, preprocessed if *use_cpp*
+        is True. *preprocessor* is one of `PREPROCESSORS`: ``'cpp'``
+        runs the external cpp, ``'python'`` uses the in-process
+        `babbisch.preprocessor` with the same options.
+    """
+    include_dir = os.path.join(HEADER_REPLACEMENTS, 'usr', 'include')
+    # We just provide with a custom (but hackish) va_list
+    # typedef in our own .h
+    valist = os.path.join(HEADER_REPLACEMENTS, 'valist.h')
+    if not use_cpp:
+        text = open(filename).read()
+    elif preprocessor == 'python':
+        text = Preprocessor(include_dirs=[include_dir]).preprocess(
+                filename, includes=[valist])
+    else:
         path_list = [
                 'cpp',
                 '-U __GNUC__',
-                '-isystem', os.path.join(HEADER_REPLACEMENTS, 'usr', 'include'),
-                # We just provide with a custom (but hackish) va_list
-                # typedef in our own .h
-                '-include', os.path.join(HEADER_REPLACEMENTS, 'valist.h'),
+                '-isystem', include_dir,
+                '-include', valist,
                 filename,
                 ]
-        print path_list
         pipe = Popen(path_list,
                     stdout=PIPE,
                     universal_newlines=True)
         text = pipe.communicate()[0]
-    else:
-        text = open(filename).read()
+    return text
 
+def parse_text(text, filename, verbose=True):
+    """
+        parse the preprocessed *text* of *filename*. If it can't be
+        parsed and *verbose* is True, *text* is printed to stderr.
+    """
     parser = CParser()
     # strip __extension__
     text = text.replace('__extension__', '')
     try:
         return parser.parse(text, filename)
     except ParseError:
-        print >>sys.stderr, text
+        if verbose:
+            print >>sys.stderr, text
         raise
 
+def parse_file(filename, use_cpp=True, preprocessor='cpp'):
+    return parse_text(preprocess(filename, use_cpp, preprocessor), filename)
+
 class ASTCache(object):
     # TODO: store the mtime when loading the header. Otherwise it is
     # possible to store a mtime that is more recent than the header.
 
-    def __init__(self, filename=CACHE_FILENAME, load=True, use_cpp=True):
+    # The ASTs are stored in the compact form of `babbisch.slim`. If the
+    # include function passed to `get_header` has a `key` attribute (like
+    # the ones returned by `include_exclude`), only the declarations the
+    # analysis of the included headers needs are stored. Entries are
+    # kept per preprocessor, so their outputs can be compared.
+
+    def __init__(self, filename=CACHE_FILENAME, load=True, use_cpp=True,
+            preprocessor='cpp'):
         self.filename = filename
         self.use_cpp = use_cpp
-        self.headers = {} # (filename, iheaders, xheaders): (mtime, ast)
+        self.preprocessor = preprocessor
+        self.verbose = True # see `parse_text`
+        self.headers = {} # (filename, include key, preprocessor): (mtime, slimmed ast, dependencies)
+        self.updated = set() # keys of the headers (re)parsed since loading
         if load:
             self.load()
 
     def load(self):
         self.headers.clear()
+        self.updated.clear()
         try:
             with open(self.filename, 'rb') as f:
-                self.headers = pickle.load(f)
-        except IOError:
-            pass
+                version, headers = pickle.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        # ignore caches written by other versions
+        if version == CACHE_VERSION:
+            self.headers = headers
 
     def save(self):
         with open(self.filename, 'wb') as f:
-            pickle.dump(self.headers, f)
+            pickle.dump((CACHE_VERSION, self.headers), f,
+                    pickle.HIGHEST_PROTOCOL)
 
-    def load_header(self, filename):
-        self.headers[filename] = (
-                os.lstat(filename).st_mtime,
-                parse_file(filename, use_cpp=self.use_cpp)
+    def load_header(self, filename, include=None):
+        key = self._key(filename, include)
+        if key[1] is None:
+            include = None
+        text = preprocess(filename, self.use_cpp, self.preprocessor)
+        if self.use_cpp:
+            # skip files that don't exist (anymore), e.g. the ones
+            # named in linemarkers of already preprocessed input.
+            dependencies = [path for path in included_files(text)
+                    if os.path.isfile(path)]
+        else:
+            dependencies = [filename]
+        if filename not in dependencies:
+            dependencies.insert(0, filename)
+        ast = parse_text(text, filename, self.verbose)
+        self.headers[key] = (
+                newest_mtime(dependencies),
+                slim_ast(ast, include),
+                dependencies
                 )
+        self.updated.add(key)
 
-    def get_header(self, filename):
-        if filename in self.headers:
-            if os.lstat(filename).st_mtime > self.headers[filename][0]:
-                self.load_header(filename)
-        else:
-            self.load_header(filename)
-        return self.headers[filename][1]
+    def _key(self, filename, include):
+        return (filename, getattr(include, 'key', None), self.preprocessor)
+
+    def _is_stale(self, key):
+        # stale if any file read while preprocessing is gone or changed
+        mtime, slimmed, dependencies = self.headers[key]
+        newest = newest_mtime(dependencies)
+        return newest is None or mtime is None or newest > mtime
+
+    def _get_entry(self, filename, include):
+        key = self._key(filename, include)
+        if key not in self.headers or self._is_stale(key):
+            self.load_header(filename, include)
+        return self.headers[key]
+
+    def _get_slimmed(self, filename, include):
+        return self._get_entry(filename, include)[1]
+
+    def get_dependencies(self, filename, include=None):
+        """
+            return a list of all files read when preprocessing
+            *filename*, including *filename* itself.
+        """
+        return self._get_entry(filename, include)[2]
+
+    def get_header(self, filename, include=None):
+        """
+            return the `FileAST` of *filename*. If *include* is given,
+            declarations that are not needed to analyze the objects
+            from included headers may be missing.
+        """
+        return expand_ast(self._get_slimmed(filename, include))
+
+    def iter_header(self, filename, include=None):
+        """
+            like `get_header`, but yield the top-level declarations one
+            at a time, so only one of them has to be in memory.
+        """
+        return iter_decls(self._get_slimmed(filename, include))
 
@@ -0,0 +1,146 @@
+import unittest
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from babbisch.analyze import AnalyzingVisitor, Struct
+from babbisch.client import ObjectVisitor
+from babbisch.model import CANONICAL_TYPES_KEY, loads
+from babbisch.utils import parse_text
+
+def canonical_types(source):
+    visitor = AnalyzingVisitor()
+    visitor.visit(parse_text(source, '<test>'))
+    return visitor.resolve_types()
+
+class CanonicalTypesTest(unittest.TestCase):
+    def test_opaque(self):
+        types = canonical_types('''
+            struct full { int a; };
+            typedef struct full full_t;
+            void use(struct full *p);
+            struct hidden;
+            typedef struct hidden hidden_t;
+            typedef struct { int b; } anon_t;
+            ''')
+        self.assertFalse(types['full_t']['opaque'])
+        self.assertFalse(types['STRUCT(full)']['opaque'])
+        self.assertTrue(types['hidden_t']['opaque'])
+        self.assertTrue(types['STRUCT(hidden)']['opaque'])
+        self.assertFalse(types['anon_t']['opaque'])
+
+    def test_cyclic(self):
+        types = canonical_types('''
+            typedef struct node node_t;
+            struct node { node_t *next; int value; };
+            struct list { struct list *next; };
+            typedef struct list list_t;
+            struct a;
+            struct b { struct a *a; };
+            struct a { struct b *b; };
+            struct plain { int x; char *name; };
+            typedef struct plain plain_t;
+            struct holder { struct list *first; };
+            void walk(struct node *n);
+            ''')
+        for key in ['node_t', 'STRUCT(node)', 'STRUCT(list)',
+                'STRUCT(a)', 'STRUCT(b)']:
+            self.assertTrue(types[key]['cyclic'], key)
+            self.assertTrue(types[key]['reaches_cycle'], key)
+        # these only refer to a cycle
+        for key in ['list_t', 'STRUCT(holder)', 'walk']:
+            self.assertFalse(types[key]['cyclic'], key)
+            self.assertTrue(types[key]['reaches_cycle'], key)
+        for key in ['STRUCT(plain)', 'plain_t']:
+            self.assertFalse(types[key]['cyclic'], key)
+            self.assertFalse(types[key]['reaches_cycle'], key)
+        self.assertEqual(types['node_t']['canonical'], 'STRUCT(node)')
+        self.assertEqual(types['walk']['canonical'],
+                'FUNCTIONTYPE(void, POINTER(STRUCT(node)))')
+
+class CachedJsonTest(unittest.TestCase):
+    FIRST = """
+        struct later;
+        typedef int foo_t;
+        typedef struct later later_t;
+        struct s { foo_t a; struct later *next; struct { foo_t x; } in; };
+        typedef struct { foo_t y; } anon_t;
+        foo_t get(later_t *l, struct s *s);
+        """
+    SECOND = """
+        typedef long foo_t;
+        struct later { foo_t b; struct s *s; };
+        typedef struct s s_t;
+        s_t *make(foo_t size, union added { int i; } u);
+        """
+
+    def test_cached_fragments_after_changes(self):
+        for options in [{}, {'indent': 2}, {'indent': 2, 'sort_keys': True},
+                {'sort_keys': True}]:
+            visitor = AnalyzingVisitor()
+            visitor.visit(parse_text(self.FIRST, '<first>'))
+            # fill the state and fragment caches
+            visitor.to_json(**options)
+            visitor.visit(parse_text(self.SECOND, '<second>'))
+            fresh = AnalyzingVisitor()
+            fresh.visit(parse_text(self.FIRST, '<first>'))
+            fresh.visit(parse_text(self.SECOND, '<second>'))
+            self.assertEqual(visitor.to_json(**options),
+                    fresh.to_json(**options))
+            self.assertEqual(json.loads(visitor.to_json(**options)),
+                    json.loads(fresh.to_json()))
+
+    def test_cached_fragments_after_lookup_changes(self):
+        # headers never remove a tag or change an object once it is
+        # created, so do that directly
+        def remove(visitor):
+            del visitor.objects['STRUCT(later)']
+        def add(visitor):
+            visitor.objects['STRUCT(later)'] = Struct(None, 'later')
+        def change(visitor):
+            visitor.objects['STRUCT(s)'].add_member('added',
+                    visitor.objects['foo_t'], 3)
+        def change_inline(visitor):
+            visitor.objects['anon_t'].target.add_member('z',
+                    visitor.objects['int'], None)
+        steps = [remove, add, change, change_inline]
+        for options in [{}, {'indent': 2, 'sort_keys': True}]:
+            visitor = AnalyzingVisitor()
+            visitor.visit(parse_text(self.FIRST, '<first>'))
+            outputs = [visitor.to_json(**options)]
+            for count, step in enumerate(steps):
+                step(visitor)
+                fresh = AnalyzingVisitor()
+                fresh.visit(parse_text(self.FIRST, '<first>'))
+                for earlier in steps[:count + 1]:
+                    earlier(fresh)
+                outputs.append(visitor.to_json(**options))
+                self.assertEqual(outputs[-1], fresh.to_json(**options))
+            self.assertEqual(len(set(outputs)), len(outputs))
+
+class ModelTest(unittest.TestCase):
+    def test_canonical_types_not_an_object(self):
+        visitor = AnalyzingVisitor()
+        visitor.visit(parse_text('''
+            struct s { int a; };
+            typedef struct s s_t;
+            ''', '<test>'))
+        visitor.resolve_types()
+        model = loads(visitor.to_json())
+        self.assertEqual(model.canonical_type('s_t')['canonical'], 'STRUCT(s)')
+        self.assertTrue(CANONICAL_TYPES_KEY in model)
+        self.assertEqual(model.by_class('CanonicalTypes'), [])
+        self.assertFalse([obj for obj in model.unique_objects()
+            if obj['tag'] == CANONICAL_TYPES_KEY])
+        visited = []
+        class Visitor(ObjectVisitor):
+            def generic_visit(self, obj):
+                visited.append(obj['class'])
+        Visitor().visit_model(model)
+        self.assertFalse('CanonicalTypes' in visited)
+        self.assertTrue('Struct' in visited)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+from __future__ import with_statement
+
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+
+from babbisch.analyze import AnalyzingVisitor
+from babbisch.corpus import analyze_corpus
+from babbisch.filter import include_exclude
+from babbisch.model import loads
+from babbisch.utils import ASTCache, parse_text, preprocess
+
+def touch_later(filename):
+    # make sure the mtime changes even on filesystems with coarse timestamps
+    later = time.time() + 10
+    os.utime(filename, (later, later))
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.outer = self.write('outer.h', '#include "inner.h"\nfoo_t f(void);\n')
+        self.inner = self.write('inner.h', 'typedef int foo_t;\n')
+        self.cache_filename = os.path.join(self.tmp, 'header.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        filename = os.path.join(self.tmp, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def analyze(self):
+        cache = ASTCache(self.cache_filename, preprocessor='python')
+        visitor = AnalyzingVisitor(
+                include=include_exclude([self.outer, self.inner], []))
+        visitor.visit_decls(cache.iter_header(self.outer, visitor.include))
+        cache.save()
+        return loads(visitor.to_json())
+
+    def test_changed_dependency(self):
+        self.assertEqual(self.analyze()['foo_t']['target'], 'signed int')
+        self.write('inner.h', 'typedef long foo_t;\n')
+        touch_later(self.inner)
+        self.assertEqual(self.analyze()['foo_t']['target'], 'signed long')
+
+    def test_removed_dependency(self):
+        self.analyze()
+        cache = ASTCache(self.cache_filename, preprocessor='python')
+        include = include_exclude([self.outer, self.inner], [])
+        self.assertEqual(cache.get_dependencies(self.outer, include)[-1], self.inner)
+        # the header doesn't include it anymore, and it's gone
+        self.write('outer.h', 'typedef char foo_t;\n')
+        os.utime(self.outer, (0, 0))
+        os.remove(self.inner)
+        self.assertEqual(self.analyze()['foo_t']['target'], 'signed char')
+
+    def test_corpus_changed_dependency(self):
+        os.makedirs(os.path.join(self.tmp, 'corpus'))
+        self.write('corpus/outer.h', '#include "../inner.h"\nfoo_t f(void);\n')
+        corpus = os.path.join(self.tmp, 'corpus')
+        outdir = os.path.join(self.tmp, 'out')
+        for expected in [(1, 0), (0, 1)]:
+            self.assertEqual(analyze_corpus(corpus, outdir, jobs=1,
+                preprocessor='python'), expected + ([],))
+        touch_later(self.inner)
+        self.assertEqual(analyze_corpus(corpus, outdir, jobs=1,
+            preprocessor='python'), (1, 0, []))
+
+class SlimmedCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        filename = os.path.join(self.tmp, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def test_same_output_as_full_ast(self):
+        self.write('sys.h', """
+typedef int sys_int;
+struct unused { int u; };
+typedef struct unused unused_t;
+typedef sys_int sys_size;
+""")
+        # a later redeclaration in an excluded header replaces the
+        # definition of struct foo, so it has to stay
+        self.write('late.h', """
+struct foo *late_get(void);
+unused_t late_unrelated(void);
+""")
+        main = self.write('main.h', """
+#include "sys.h"
+struct foo { sys_int a; sys_size b; };
+typedef struct foo foo_t;
+#include "late.h"
+foo_t *make(void);
+""")
+        include = include_exclude([re.escape(main) + '$'], [])
+        text = preprocess(main, preprocessor='python')
+        full = AnalyzingVisitor(include=include)
+        full.visit(parse_text(text, main))
+        full.resolve_types()
+        cache = ASTCache(load=False, preprocessor='python')
+        slimmed = AnalyzingVisitor(include=include)
+        slimmed.visit_decls(cache.iter_header(main, include))
+        slimmed.resolve_types()
+        self.assertEqual(slimmed.to_json(indent=2, sort_keys=True),
+                full.to_json(indent=2, sort_keys=True))
+        names = [decl.name for decl in cache.iter_header(main, include)]
+        self.assertTrue('late_get' in names)
+        self.assertFalse('unused_t' in names)
+        self.assertFalse('late_unrelated' in names)
+
+if __name__ == '__main__':
+    unittest.main()
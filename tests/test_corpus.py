@@ -0,0 +1,98 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from babbisch import corpus
+from babbisch.corpus import analyze_corpus, create_schema, DATABASE_FILENAME
+
+HEADER = """
+typedef struct { int a; long b; } s%(n)d_t;
+int f%(n)d(s%(n)d_t *s, unsigned char c);
+"""
+
+class CorpusTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.corpus = os.path.join(self.tmp, 'corpus')
+        os.makedirs(os.path.join(self.corpus, 'sub'))
+        self.headers = []
+        for n in range(8):
+            path = os.path.join(self.corpus, 'sub' if n % 2 else '', 'h%d.h' % n)
+            with open(path, 'w') as f:
+                f.write(HEADER % {'n': n})
+            self.headers.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_new_database_with_several_workers(self):
+        # all workers start writing to the database at the same time
+        for run in range(5):
+            outdir = os.path.join(self.tmp, 'out%d' % run)
+            analyzed, skipped, failures = analyze_corpus(self.corpus,
+                    outdir, jobs=4, preprocessor='python')
+            self.assertEqual(failures, [])
+            self.assertEqual((analyzed, skipped), (len(self.headers), 0))
+            conn = sqlite3.connect(os.path.join(outdir, DATABASE_FILENAME))
+            try:
+                names = sorted(row[0] for row in conn.execute('SELECT name FROM runs'))
+            finally:
+                conn.close()
+            self.assertEqual(names, sorted(self.headers))
+
+    def test_skip_done_headers(self):
+        outdir = os.path.join(self.tmp, 'out')
+        analyze_corpus(self.corpus, outdir, jobs=2, preprocessor='python')
+        analyzed, skipped, failures = analyze_corpus(self.corpus, outdir,
+                jobs=2, preprocessor='python')
+        self.assertEqual((analyzed, skipped, failures), (0, len(self.headers), []))
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.database = os.path.join(self.tmp, DATABASE_FILENAME)
+        create_schema(self.database)
+        # run the worker in this process, without a shared cache
+        corpus._init_worker(None, 'python')
+
+    def tearDown(self):
+        corpus._cache = None
+        corpus._collect = False
+        shutil.rmtree(self.tmp)
+
+    def analyze(self, name, text):
+        header = os.path.join(self.tmp, name)
+        with open(header, 'w') as f:
+            f.write(text)
+        task = (header, header + '.json', self.database, [], [])
+        return corpus.analyze_header(task)
+
+    def test_no_cache_keeps_no_asts(self):
+        for n in range(3):
+            header, entries, error = self.analyze('h%d.h' % n, HEADER % {'n': n})
+            self.assertEqual((entries, error), ({}, None))
+            self.assertEqual(corpus._cache.headers, {})
+        header, entries, error = self.analyze('broken.h', 'int broken(;\n')
+        self.assertTrue('ParseError' in error)
+        self.assertEqual(corpus._cache.headers, {})
+
+    def test_parse_error_not_printed(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            header, entries, error = self.analyze('broken.h',
+                    'int unique_declaration_name;\nint broken(;\n')
+            printed = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue('ParseError' in error)
+        self.assertFalse('unique_declaration_name' in printed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from babbisch.analyze import AnalyzingVisitor
+from babbisch.database import write_database
+from babbisch.utils import parse_text
+
+def analyze(source):
+    visitor = AnalyzingVisitor()
+    visitor.visit(parse_text(source, 'test.h'))
+    return visitor
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'types.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, source, name=None):
+        write_database(analyze(source), self.filename, name)
+
+    def query(self, sql, *args):
+        conn = sqlite3.connect(self.filename)
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def member_types(self, run, key):
+        """
+            return ``(member, tag)`` for the members of the object *key*
+            of the *run*th run, with typedefs followed once.
+        """
+        return self.query('''
+            SELECT m.name, target.tag FROM keys k
+                JOIN runs r ON k.run_id = r.id
+                JOIN members m ON m.object_id = k.object_id
+                JOIN objects t ON m.type_id = t.id
+                JOIN objects target ON t.type_id = target.id
+            WHERE r.id = ? AND k.key = ?
+            ORDER BY m.position''', run, key)
+
+    def object_id(self, run, key):
+        return self.query('SELECT object_id FROM keys '
+                'WHERE run_id = ? AND key = ?', run, key)[0][0]
+
+    def count(self, table):
+        return self.query('SELECT COUNT(*) FROM %s' % table)[0][0]
+
+    def test_cairo_query(self):
+        # the example from the module docstring
+        self.write('''
+            typedef struct _cairo cairo_t;
+            void cairo_destroy(cairo_t *cr);
+            int cairo_status(cairo_t *cr, int flags);
+            void other(int *p);
+            ''')
+        names = self.query('''
+            SELECT DISTINCT f.name FROM objects f
+                JOIN arguments a ON a.object_id = f.id
+                JOIN objects t ON a.type_id = t.id
+            WHERE f.class = 'Function' AND t.tag = 'POINTER(cairo_t)'
+            ORDER BY f.name''')
+        self.assertEqual(names, [('cairo_destroy',), ('cairo_status',)])
+
+    def test_dedup_across_runs(self):
+        first = '''
+            typedef int foo_t;
+            struct s { foo_t x; };
+            struct node { struct node *next; foo_t value; };
+            '''
+        self.write(first)
+        objects = self.count('objects')
+        self.write(first)
+        self.assertEqual(self.count('objects'), objects)
+        self.assertEqual(self.count('runs'), 2)
+        # same structs, but foo_t is something else
+        self.write(first.replace('typedef int', 'typedef long'))
+        for key in ['foo_t', 'STRUCT(s)', 'STRUCT(node)']:
+            ids = [self.object_id(run, key) for run in (1, 2, 3)]
+            self.assertEqual(ids[0], ids[1])
+            self.assertNotEqual(ids[0], ids[2])
+        self.assertEqual(self.member_types(1, 'STRUCT(s)'),
+                [('x', 'signed int')])
+        self.assertEqual(self.member_types(3, 'STRUCT(s)'),
+                [('x', 'signed long')])
+        self.assertEqual(self.member_types(3, 'STRUCT(node)'),
+                [('next', 'STRUCT(node)'), ('value', 'signed long')])
+        # every object has its members only once
+        self.assertEqual(self.query('''
+            SELECT object_id, position FROM members
+            GROUP BY object_id, position HAVING COUNT(*) > 1'''), [])
+
+    def test_replace_named_run(self):
+        self.write('int a(void);', 'lib')
+        self.write('int b(void);', 'other')
+        self.write('int c(void);', 'lib')
+        runs = self.query('SELECT id, name FROM runs ORDER BY id')
+        self.assertEqual([name for id, name in runs], ['other', 'lib'])
+        keys = self.query('''
+            SELECT r.name, k.key FROM keys k JOIN runs r ON k.run_id = r.id
+            WHERE k.key IN ('a', 'b', 'c') ORDER BY k.key''')
+        self.assertEqual(keys, [('other', 'b'), ('lib', 'c')])
+
+if __name__ == '__main__':
+    unittest.main()
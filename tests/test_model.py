@@ -0,0 +1,113 @@
+import unittest
+from StringIO import StringIO
+
+from babbisch.analyze import AnalyzingVisitor
+from babbisch.client import ObjectVisitor
+from babbisch.model import ModelObject, Reference, load, loads
+from babbisch.utils import parse_text
+
+SOURCE = '''
+typedef struct s { int a; } s_t;
+typedef struct { int x; } anon_a;
+typedef struct { char *y; } anon_b;
+struct outer { union { int i; float f; } u; s_t *next; };
+s_t *make(int size);
+'''
+
+def analyze(source):
+    visitor = AnalyzingVisitor()
+    visitor.visit(parse_text(source, 'test.h'))
+    visitor.resolve_types()
+    return visitor.to_json()
+
+class ModelTest(unittest.TestCase):
+    def setUp(self):
+        self.json = analyze(SOURCE)
+        self.model = loads(self.json)
+
+    def test_load(self):
+        model = load(StringIO(self.json))
+        self.assertEqual(list(model), list(self.model))
+        self.assertEqual(model['STRUCT(s)'], self.model['STRUCT(s)'])
+        obj = model['STRUCT(s)']
+        self.assertTrue(isinstance(obj, ModelObject))
+        self.assertEqual(obj['members'], (('a', 'signed int', None),))
+        self.assertRaises(TypeError, obj.__setitem__, 'name', 'x')
+
+    def test_resolve_tags(self):
+        model = self.model
+        self.assertTrue(model.resolve('STRUCT(s)') is model['STRUCT(s)'])
+        self.assertTrue(model.resolve('int') is model['int'])
+        pointer = model.resolve('POINTER(STRUCT(s))')
+        self.assertTrue(isinstance(pointer, Reference))
+        self.assertEqual(pointer.modifier, 'POINTER')
+        self.assertTrue(pointer.args[0] is model['STRUCT(s)'])
+        self.assertTrue(model.resolve('POINTER(STRUCT(s))') is pointer)
+
+    def test_resolve_inline(self):
+        model = self.model
+        a = model.resolve(model['anon_a']['target'])
+        b = model.resolve(model['anon_b']['target'])
+        u = model.resolve(model['STRUCT(outer)']['members'][0][1])
+        self.assertEqual((a['class'], a['members'][0][0]), ('Struct', 'x'))
+        self.assertEqual((b['class'], b['members'][0][0]), ('Struct', 'y'))
+        self.assertEqual(u['class'], 'Union')
+        self.assertTrue(model.resolve(model['anon_a']['target']) is a)
+        # inline states of known objects resolve to those
+        state = dict(model['STRUCT(s)'])
+        self.assertTrue(model.resolve(state) is model['STRUCT(s)'])
+
+    def test_indexes(self):
+        model = self.model
+        self.assertEqual(model.by_name('s'), [model['STRUCT(s)']])
+        self.assertEqual(model.by_name('make'), [model['make']])
+        self.assertEqual(sorted(obj['tag'] for obj in model.by_class('Typedef')),
+                ['anon_a', 'anon_b', 's_t'])
+        self.assertEqual(sorted(obj['tag'] for obj in model.by_file('test.h')),
+                sorted(['STRUCT(s)', 's_t', 'anon_a', 'anon_b',
+                    'STRUCT(outer)', 'make']))
+        self.assertEqual(model.by_file('other.h'), [])
+        # builtins have synonyms, but are only indexed once
+        tags = [obj['tag'] for obj in model.unique_objects()]
+        self.assertEqual(len(tags), len(set(tags)))
+        self.assertEqual([obj['tag'] for obj in model.by_name('signed int')],
+                ['signed int'])
+
+class ObjectVisitorTest(unittest.TestCase):
+    def test_dispatch(self):
+        visited = []
+        class Visitor(ObjectVisitor):
+            def visit_Struct(self, obj):
+                visited.append(('struct', obj['tag']))
+            def generic_visit(self, obj):
+                visited.append(('generic', obj['class']))
+        visitor = Visitor()
+        visitor.visit_Function = lambda obj: visited.append(('function', obj['tag']))
+        model = loads(analyze(SOURCE))
+        visitor.visit_model(model)
+        self.assertTrue(('struct', 'STRUCT(s)') in visited)
+        self.assertTrue(('function', 'make') in visited)
+        self.assertFalse(('generic', 'Function') in visited)
+        self.assertTrue(('generic', 'Typedef') in visited)
+        # instances have their own tables, which are built once
+        self.assertFalse('Function' in Visitor().get_dispatch_table())
+        visitor.visit_Typedef = lambda obj: visited.append(('typedef', obj['tag']))
+        visitor.visit(model['s_t'])
+        self.assertEqual(visited[-1], ('generic', 'Typedef'))
+        visitor.reset_dispatch_table()
+        visitor.visit(model['s_t'])
+        self.assertEqual(visited[-1], ('typedef', 's_t'))
+
+    def test_not_handlers(self):
+        table = ObjectVisitor().get_dispatch_table()
+        self.assertFalse('objects' in table)
+        self.assertFalse('model' in table)
+        visited = []
+        class Visitor(ObjectVisitor):
+            def generic_visit(self, obj):
+                visited.append(obj['class'])
+        Visitor().visit(ModelObject({'class': 'model', 'tag': 'x'}))
+        self.assertEqual(visited, ['model'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+from __future__ import with_statement
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+from subprocess import Popen, PIPE
+
+from pycparser import c_ast
+
+import babbisch
+from babbisch import write_json
+from babbisch.analyze import AnalyzingVisitor
+from babbisch.utils import parse_text
+
+HEADER = """
+typedef struct { int a; } s_t;
+int f(s_t *s);
+"""
+
+def analyze(source):
+    visitor = AnalyzingVisitor()
+    visitor.visit(parse_text(source, 'test.h'))
+    visitor.resolve_types()
+    return visitor
+
+def reported_hash(stderr):
+    # the last line is "<hexdigest>  <filename>", like sha1sum
+    return stderr.splitlines()[-1].split()[0]
+
+class OutputTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+        shutil.rmtree(self.tmp)
+
+    def test_unchanged_output_keeps_mtime(self):
+        filename = os.path.join(self.tmp, 'out.json')
+        write_json(analyze(HEADER), filename)
+        os.utime(filename, (1000000000, 1000000000))
+        write_json(analyze(HEADER), filename)
+        self.assertEqual(os.stat(filename).st_mtime, 1000000000)
+        write_json(analyze(HEADER + 'int g(void);\n'), filename)
+        self.assertNotEqual(os.stat(filename).st_mtime, 1000000000)
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self.assertEqual(reported_hash(sys.stderr.getvalue()), digest)
+        self.assertEqual(os.listdir(self.tmp), ['out.json'])
+
+    def test_stdout_hash(self):
+        header = os.path.join(self.tmp, 'test.h')
+        with open(header, 'w') as f:
+            f.write(HEADER)
+        process = Popen([sys.executable, '-c', 'import babbisch; babbisch.main()',
+                '--no-cache', '--preprocessor', 'python', header],
+                stdout=PIPE, stderr=PIPE, cwd=self.tmp,
+                env=dict(os.environ, PYTHONPATH=os.path.dirname(
+                    os.path.dirname(os.path.abspath(babbisch.__file__)))))
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0, stderr)
+        self.assertEqual(reported_hash(stderr), hashlib.sha1(stdout).hexdigest())
+
+    def test_unknown_type_not_on_stdout(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            AnalyzingVisitor().resolve_type(c_ast.Constant('int', '1'))
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(printed, '')
+        self.assertTrue('Unknown type' in sys.stderr.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,366 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from subprocess import Popen, PIPE
+
+from babbisch.preprocessor import (Preprocessor, PreprocessorError, tokenize,
+        _compiler_macros, _default_macros)
+from babbisch.utils import parse_text
+
+CPP = find_executable('cpp')
+
+def output_tokens(text):
+    """
+        return the tokens of the preprocessed *text*, without
+        linemarkers and whitespace.
+    """
+    tokens = []
+    for line in text.splitlines():
+        if not line.startswith('#'):
+            tokens.extend(t for t in tokenize(line) if t != ' ')
+    return tokens
+
+def declaration_lines(text):
+    return [(decl.coord.file, decl.coord.line)
+            for decl in parse_text(text, '<test>').ext]
+
+@unittest.skipIf(CPP is None, 'cpp is not installed')
+class CompareWithCppTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        filename = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def preprocess(self, filename, include_dirs=()):
+        include_dirs = [os.path.join(self.tmp, d) for d in include_dirs]
+        args = [CPP, '-U', '__GNUC__']
+        for directory in include_dirs:
+            args.extend(['-isystem', directory])
+        cpp = Popen(args + [filename], stdout=PIPE, stderr=PIPE)
+        cpp_text = cpp.communicate()[0]
+        self.assertEqual(cpp.returncode, 0)
+        python_text = Preprocessor(include_dirs=include_dirs).preprocess(filename)
+        return cpp_text, python_text
+
+    def assertSameTokens(self, source, include_dirs=()):
+        cpp_text, python_text = self.preprocess(
+                self.write('test.h', source), include_dirs)
+        self.assertEqual(output_tokens(python_text), output_tokens(cpp_text))
+        return cpp_text, python_text
+
+    def assertSameDeclarations(self, source, include_dirs=()):
+        cpp_text, python_text = self.assertSameTokens(source, include_dirs)
+        self.assertEqual(declaration_lines(python_text),
+                declaration_lines(cpp_text))
+
+    def test_macros(self):
+        self.assertSameDeclarations('''
+#define STR(x) #x
+#define XSTR(x) STR(x)
+#define CAT(a, b) a ## b
+#define VER 3
+#define LOG(fmt, ...) printf(fmt, ## __VA_ARGS__)
+#define EMPTY()
+int CAT(foo, VER);
+const char *s = XSTR(VER) STR("a\\n");
+int e EMPTY();
+int l = __LINE__;
+void f(void) { LOG("a"); LOG("b", 1, 2); }
+''')
+
+    def test_rescan(self):
+        self.assertSameTokens('''
+#define f(x) x + g
+#define g f
+#define h(a) a*k
+#define k(a) h(a)
+int a = f(1)(2);
+int b = h(2)(9);
+''')
+
+    def test_builtins(self):
+        self.assertSameTokens('''
+#define V(a, ...) f(a __VA_OPT__(,) __VA_ARGS__)
+#define E
+#define W(...) [__VA_OPT__(x __VA_ARGS__ y)]
+#define N(x) __VA_OPT__(x)
+V(1) V(1, 2, 3) V(1,) V(1, E) W() W(E) W(a b) N(1)
+#define D defined(X)
+#define X
+#if D
+int defined_from_macro;
+#endif
+#define F(x) x
+#if F(defined) X && defined X && defined (X) && !defined Y
+int defined_operands;
+#endif
+int counter[] = { __COUNTER__, __COUNTER__, F(__COUNTER__) };
+#if defined __has_include && defined(__has_include_next)
+int has_include_defined;
+#endif
+#if defined __COUNTER__ && defined __LINE__
+int builtins_defined;
+#endif
+#ifdef __FILE__
+int file_defined;
+#endif
+#define HDR <stdio.h>
+#if __has_include(HDR) && __has_include(<stdlib.h>) && __has_include ( "test.h" )
+int found;
+#endif
+#if __has_include("missing.h") || __has_include_next(<missing.h>)
+int not_found;
+#endif
+__INT64_TYPE__ a; __UINT32_TYPE__ b; __INTPTR_TYPE__ c; __CHAR16_TYPE__ d;
+''')
+
+    def test_has_include_next(self):
+        self.write('A/x.h', '#if __has_include_next(<x.h>)\nint from_a;\n#endif\n')
+        self.write('B/x.h', '')
+        self.write('C/x.h', '#if __has_include_next(<x.h>)\nint from_c;\n#endif\n')
+        self.assertSameTokens('#include <x.h>\n', ['A', 'B'])
+        self.assertSameTokens('#include <x.h>\n', ['C'])
+
+    def test_errors(self):
+        for source in ['int x = __has_include(<stdio.h>);\n',
+                '#if __has_include(<stdio.h>\n#endif\n',
+                '#if defined 1\n#endif\n',
+                '#define Q(x) x\n#define X 1\n#if Q(defined X)\n#endif\n',
+                ]:
+            filename = self.write('test.h', source)
+            cpp = Popen([CPP, filename], stdout=PIPE, stderr=PIPE)
+            cpp.communicate()
+            self.assertNotEqual(cpp.returncode, 0, source)
+            self.assertRaises(PreprocessorError,
+                    Preprocessor().preprocess, filename)
+
+    def test_error_directive(self):
+        # cpp reports #error and goes on, and its output is used
+        filename = self.write('test.h', '#error stop\nint after_error;\n')
+        cpp = Popen([CPP, filename], stdout=PIPE, stderr=PIPE)
+        cpp_text = cpp.communicate()[0]
+        self.assertNotEqual(cpp.returncode, 0)
+        python_text = Preprocessor().preprocess(filename)
+        self.assertEqual(output_tokens(python_text), output_tokens(cpp_text))
+        self.assertTrue('after_error' in output_tokens(python_text))
+
+    def test_unsupported(self):
+        # valid for cpp, but an error rather than different output
+        for source in ['#define S(...) #__VA_OPT__(a)\nS(1)\n',
+                '#define P(a, ...) a ## __VA_OPT__(b)\nP(1, 2)\n',
+                '#define P(a, ...) __VA_OPT__(a) ## a\nP(1, 2)\n',
+                ]:
+            filename = self.write('test.h', source)
+            self.assertRaises(PreprocessorError,
+                    Preprocessor().preprocess, filename)
+
+    def test_default_macros(self):
+        # without cpp, the predefined macros are computed
+        compiler = _compiler_macros()
+        for name, value in _default_macros().iteritems():
+            self.assertEqual((name, value), (name, compiler.get(name)))
+
+    def test_standard_examples(self):
+        # C99 6.10.3.5, examples 3 and 4
+        self.assertSameTokens('''
+#define x 3
+#define f(a) f(x * (a))
+#undef x
+#define x 2
+#define g f
+#define z z[0]
+#define h g(~
+#define m(a) a(w)
+#define w 0,1
+#define t(a) a
+#define p() int
+#define q(x) x
+#define r(x,y) x ## y
+#define str(x) # x
+f(y+1) + f(f(z)) % t(t(g)(0) + t)(1);
+g(x+(3,4)-w) | h 5) & m
+(f)^m(m);
+p() i[q()] = { q(1), r(2,3), r(4,), r(,5), r(,) };
+char c[2][6] = { str(hello), str() };
+''')
+        self.assertSameTokens('''
+#define str(s) # s
+#define xstr(s) str(s)
+#define debug(s, t) printf("x" # s "= %d, x" # t "= %s", x ## s, x ## t)
+#define INCFILE(n) vers ## n
+#define glue(a, b) a ## b
+#define xglue(a, b) glue(a, b)
+#define HIGHLOW "hello"
+#define LOW LOW ", world"
+debug(1, 2);
+fputs(str(strncmp("abc\\0d", "abc", '\\4') == 0) str(: @\\n), s);
+xstr(INCFILE(2).h)
+glue(HIGH, LOW);
+xglue(HIGH, LOW)
+''')
+
+    def test_painted_names(self):
+        self.assertSameTokens('''
+#define foo foo
+#define id(x) x
+#define AA BB
+#define BB AA
+#define rec id(rec)
+#define obj(x) obj
+#define self_call(x) id(self_call)(x)
+foo id(foo) id(id(foo));
+AA BB id(AA);
+rec id(rec);
+obj(1)(2);
+self_call(1)(2);
+''')
+
+    def test_call_on_next_line(self):
+        self.assertSameDeclarations('''
+#define f(x) x + 1
+#define g(a, b) a * b
+int a = f
+ (4);
+int b = g(2,
+          3) + f
+  /* the call */
+ (5);
+int c = f;
+int d = g(f
+ (1), f(2
+  ));
+''')
+
+    def test_unsigned_conditionals(self):
+        self.assertSameDeclarations('''
+#if -1 > 0u
+int unsigned_compare;
+#endif
+#if -1 > 0
+int signed_compare;
+#endif
+#if 0xFFFFFFFFFFFFFFFF > 0 && 18446744073709551615 == -1
+int large_literal;
+#endif
+#if -1 / 2u == 0x7FFFFFFFFFFFFFFF
+int unsigned_division;
+#endif
+#if (1 ? -1 : 0u) > 0 && -1 >> 63 == -1 && -1u >> 63 == 1
+int ternary_and_shift;
+#endif
+#if ~0U == 18446744073709551615u && -0x7FFFFFFFFFFFFFFF - 1 < 0
+int complement;
+#endif
+#if 1 || 1 / 0
+int short_circuit;
+#endif
+#if (1 << -1) == 0 && (4 >> -1) == 8 && (-8 >> 1) == -4
+int negative_shift;
+#endif
+''')
+
+    def test_conditionals(self):
+        self.assertSameDeclarations('''
+#define VER 3
+#if defined(VER) && VER >= 2 && !defined UNDEF || 0
+int yes1;
+#elif 1
+#error nope
+#endif
+#if (1 ? 2 : 3) == 2 && 'a' == 97 && (-1 < 0) && 0x10 == 16 && 010 == 8
+int yes2;
+#endif
+#if 7 / 2 == 3 && -7 / 2 == -3 && -7 % 2 == -1
+int yes3;
+#endif
+''')
+
+    def test_include_next(self):
+        self.write('A/sub/x.h', '#include_next <sub/x.h>\nint from_a;\n')
+        self.write('B/sub/x.h', '#ifndef X\n#define X\nint from_b;\n#endif\n')
+        self.assertSameDeclarations('#include <sub/x.h>\nint main_decl;\n',
+                ['A', 'B'])
+
+    def test_redefined_between_includes(self):
+        # the lines of x.h are expanded again with other macros
+        self.write('x.h', '''
+int VALUE = F(1) G;
+#if LEVEL > 1
+int level_two;
+#endif
+''')
+        self.assertSameTokens('''
+#define INNER 1
+#define VALUE a
+#define F(x) x + INNER
+#define G
+#define LEVEL 1
+#include "x.h"
+#undef INNER
+#define INNER 2
+#include "x.h"
+#undef LEVEL
+#define LEVEL 2
+#include "x.h"
+#undef G
+#define G(x) x
+#include "x.h"
+#undef VALUE
+#define VALUE b
+#include "x.h"
+''')
+
+    def test_system_limits(self):
+        # gcc's limits.h includes "syslimits.h", whose #include_next
+        # <limits.h> has to get to glibc's limits.h
+        filename = self.write('test.h',
+                '#include <limits.h>\nstruct p { char name[PATH_MAX]; };\n')
+        cpp_text, python_text = self.preprocess(filename)
+        self.assertEqual(output_tokens(python_text), output_tokens(cpp_text))
+        self.assertFalse('PATH_MAX' in output_tokens(python_text))
+        preprocessor = Preprocessor()
+        preprocessor.preprocess(filename)
+        cpp = Popen([CPP, '-U', '__GNUC__', '-M', filename], stdout=PIPE)
+        dependencies = cpp.communicate()[0].replace('\\\n', ' ').split()[1:]
+        self.assertEqual(sorted(preprocessor.included),
+                sorted(set(os.path.normpath(d) for d in dependencies)))
+
+    def test_multiline_comments(self):
+        self.assertSameDeclarations('''
+#define DEF /* multi
+line */ 42
+int d = DEF;
+#if 1 /* a comment
+spanning lines */ && DEF == 42
+int in_if;
+#endif
+int a; /* one
+two */ int b;
+// continued \\
+int not_declared;
+int after_line_comment;
+/*
+ * a block comment
+ */
+int after_block_comment;
+#define CONTINUED 1 + \\
+    2 /* a comment
+    */ + 3
+int continued = CONTINUED;
+''')
+
+if __name__ == '__main__':
+    unittest.main()